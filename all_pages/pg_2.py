@@ -4,7 +4,7 @@ import streamlit_antd_components as sac
 
 from all_pages.pg_record_view import aggrid_view
 from api_calls import get_frequency_counts, update_display_df
-from plots import plot_altair_freq_pie, plot_freq_pie
+from plots import plot_altair_freq_pie, plot_freq_pie, resolve_other
 
 from utils import (
     settings_menu,
@@ -35,7 +35,7 @@ def demo_p2():
             return_select = tree_select(st.session_state.treestructures)
     with col_Right:
 
-        parent_attributes = [a for a in st.session_state.attributes_list if a.HasChildren]
+        parent_attributes = st.session_state.attribute_registry.parents()
         parent_attribute_names = [a.AttributeName for a in parent_attributes]
         selected_parent = st.selectbox(
             "Select Parent Attribute", options=parent_attribute_names
@@ -86,9 +86,15 @@ def demo_p2():
         for point in st.session_state[piename]["selection"]["param_1"]:
             idlist.append(point["attId"])
             setlist.append(point["setId"])
+        # the "Other" slice stands for all codes beyond the ones shown
+        idlist, setlist = resolve_other(
+            freqs, st.session_state.max_codes_slider_value, idlist, setlist
+        )
         update_display_df(idlist, setlist)
+        st.session_state.display_selection = list(zip(idlist, setlist))
 
     if st.session_state.display_df.shape[0] > 0:
-        downloader(st.session_state.display_df)
-        # FIXME: need to make changes to use full dataframe
+        downloader(
+            st.session_state.display_df, st.session_state.display_selection
+        )
         aggrid_view(st.session_state.display_df)
@@ -3,9 +3,9 @@
 import plotly.express as px
 import streamlit as st
 from api_calls import (
-    add_years_to_attribute_df,
+    attributes_for_years,
     attributes_to_hierarchical,
-    clean_dedupe_attributes,
+    get_year_cube,
 )
 
 
@@ -24,20 +24,10 @@ def demo_p3():
              to demonstrate various approaches to "
         "visualising hierarchical data. "
         "Beyond selecting a specific visualisation style, "
-        "we can also subset our data by a year range. "
-        "Please note: this annualised data is currenlty "
-        "synthetic -- we will hopefully replace it with "
-        "real-world data asap. "
+        "with local analytics on we can also subset our data by a "
+        "year range; records without a publication year are then not counted."
     )
 
-    df = attributes_to_hierarchical()
-    attributes_years_df = add_years_to_attribute_df(df)
-
-    if "year_range" not in st.session_state:
-        years = sorted(attributes_years_df["year"].unique())
-        st.session_state.year_range = (min(years), max(years))
-        st.session_state.plot_df = df  # Store initial plot data
-
     if "plot_type" not in st.session_state:
         st.session_state.plot_type = "Sunburst"
 
@@ -49,59 +39,75 @@ def demo_p3():
     )
     st.session_state.plot_type = plot_type
 
-    years = sorted(attributes_years_df["year"].unique())
-    min_year, max_year = min(years), max(years)
-
-    selected_range = st.slider(
-        "Select Year Range",
-        min_value=min_year,
-        max_value=max_year,
-        value=(min_year, max_year),
-        step=1,
-        help="Filter data by year range",
-    )
-
-    # plot updater button
-    if st.button("Update Plot"):
-        st.session_state.year_range = selected_range
-
-        filtered_df = attributes_years_df[
-            (attributes_years_df["year"] >= selected_range[0])
-            & (attributes_years_df["year"] <= selected_range[1])
-        ]
-        # update plot data
-        st.session_state.plot_df = clean_dedupe_attributes(
-            filtered_df.groupby(["character", "parent"], as_index=False)["value"].sum()
+    if st.session_state.local_analytics:
+        # attribute x year counts with cumulative sums, so any year range is
+        # one subtraction per attribute
+        cube = get_year_cube()
+        if cube.first_year is None:
+            st.warning("No publication years found in the records.")
+            return
+        min_year, max_year = cube.first_year, cube.last_year
+
+        if st.session_state.get("plot_df_source") != "years":
+            st.session_state.plot_df_source = "years"
+            st.session_state.year_range = (min_year, max_year)
+            # Store initial plot data
+            st.session_state.plot_df = attributes_for_years(cube, min_year, max_year)
+
+        selected_range = st.slider(
+            "Select Year Range",
+            min_value=min_year,
+            max_value=max_year,
+            value=(min_year, max_year),
+            step=1,
+            help="Filter data by year range",
         )
 
+        # plot updater button
+        if st.button("Update Plot"):
+            st.session_state.year_range = selected_range
+            # update plot data
+            st.session_state.plot_df = attributes_for_years(cube, *selected_range)
+        period = "Data from {} to {}".format(*st.session_state.year_range)
+    else:
+        # all years, from the frequency counts of the parent codes
+        st.info("Turn on local analytics to subset the data by a year range.")
+        if st.session_state.get("plot_df_source") != "all":
+            st.session_state.plot_df_source = "all"
+            st.session_state.plot_df = attributes_to_hierarchical()
+        period = "All years"
+
     if st.session_state.plot_type == "Sunburst":
         fig = px.sunburst(
             st.session_state.plot_df,
+            ids="ids",
             names="character",
-            parents="parent",
+            parents="parents",
             values="value",
             branchvalues="total",
-            title=f"Sunburst Plot: Data from {st.session_state.year_range[0]} to {st.session_state.year_range[1]}",
+            title=f"Sunburst Plot: {period}",
         )
     elif st.session_state.plot_type == "Icicle":
         fig = px.icicle(
             st.session_state.plot_df,
+            ids="ids",
             names="character",
-            parents="parent",
+            parents="parents",
             values="value",
             branchvalues="total",
-            title=f"Icicle Plot: Data from {st.session_state.year_range[0]} to {st.session_state.year_range[1]}",
+            title=f"Icicle Plot: {period}",
         )
     elif st.session_state.plot_type == "Treemap":
         fig = px.treemap(
             st.session_state.plot_df,
             values="value",
+            ids="ids",
             names="character",
-            parents="parent",
+            parents="parents",
             #color='lifeExp',
             hover_data=["value"],
             color_continuous_scale='RdBu',
-            title=f"Treemap Plot: Data from {st.session_state.year_range[0]} to {st.session_state.year_range[1]}",
+            title=f"Treemap Plot: {period}",
 
             #color_continuous_midpoint=np.average(df['lifeExp'], weights=df['pop'])
         ).update_layout(
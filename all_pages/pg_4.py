@@ -1,12 +1,10 @@
-from math import ceil
-
 import all_pages.pg_record_view
 import matplotlib as mpl
 import matplotlib.pyplot as plt
 import pandas as pd
 import seaborn as sns
 import streamlit as st
-from api_calls import req_first_page, req_next_page
+from api_calls import fetch_all_records, get_client, get_incidence_matrix, local_records
 from st_aggrid import AgGrid, GridOptionsBuilder, JsCode
 from titlecase import titlecase
 
@@ -85,12 +83,11 @@ def req_crosstab(_x_attribute, _y_attribute):
         "included": True,
         "graphic": "table"
     }
-    record_json = st.session_state.session.post("https://eppi.ioe.ac.uk/eppi-vis/Frequencies/GetCrosstabJSON",
-                                                data=payload, cookies={"WebDbErLoginCookie": st.session_state.cookie})
+    record_json = get_client().request_json("POST", "Frequencies/GetCrosstabJSON", payload)
     # read dataframe with a column of record count arrays
-    df = pd.DataFrame(record_json.json()["rows"])
+    df = pd.DataFrame(record_json["rows"])
 
-    data = {_x_attribute.AttributeName: record_json.json()["columnAttNames"]}
+    data = {_x_attribute.AttributeName: record_json["columnAttNames"]}
     # convert count arrays into columns
     for i in range(len(df)):
         col_name = df["attributeName"][i]
@@ -105,10 +102,34 @@ def req_crosstab(_x_attribute, _y_attribute):
     return df
 
 
-def aggrid_view(df, x_attribute, y_attribute):
+def local_crosstab(x_attribute, y_attribute):
+    """
+    The crosstab of req_crosstab, computed in-process from the incidence matrix.
+    """
+    registry = st.session_state.attribute_registry
+    x_children = registry.children(x_attribute.AttributeId)
+    y_children = registry.children(y_attribute.AttributeId)
+    counts = get_incidence_matrix().crosstab([a.AttributeId for a in x_children],
+                                             [a.AttributeId for a in y_children])
+
+    data = {x_attribute.AttributeName: [a.AttributeName for a in x_children]}
+    for j, y_child in enumerate(y_children):
+        col_name = y_child.AttributeName
+        # same name clash handling as in req_crosstab
+        if col_name == x_attribute.AttributeName:
+            col_name += " ({})".format(y_attribute.AttributeName)
+        data[col_name] = counts[:, j]
+
+    return pd.DataFrame(data)
+
+
+def aggrid_view(df, x_parent, y_parent):
     """
     Configure AgGrid options and display given DataFrame.
+    x_parent and y_parent are the parent attributes the crosstab was requested for.
     """
+    x_attribute = x_parent.AttributeName
+    y_attribute = y_parent.AttributeName
 
     # store all counts
     all_data = pd.Series(df.loc[:, df.columns != x_attribute].values.ravel("F"))
@@ -143,28 +164,25 @@ def aggrid_view(df, x_attribute, y_attribute):
             col_name = col_name.replace(" ({0})".format(y_attribute), "")
 
         # get attributes
-        x_sub_attribute = [a for a in st.session_state.attributes_list
-                           if ag.data.iloc[row_index][x_attribute] == a.AttributeName and not a.HasChildren][0]
-        y_sub_attribute = [a for a in st.session_state.attributes_list
-                           if col_name == a.AttributeName and not a.HasChildren][0]
+        registry = st.session_state.attribute_registry
+        x_sub_attribute = registry.find(ag.data.iloc[row_index][x_attribute], x_parent.AttributeId)
+        y_sub_attribute = registry.find(col_name, y_parent.AttributeId)
         selected_searchable = [x_sub_attribute.AttributeId, y_sub_attribute.AttributeId]
         set_ids = [x_sub_attribute.SetId, y_sub_attribute.SetId]
 
-        total_records = 0
-        df = pd.DataFrame()
-        # first page
-        if len(selected_searchable) > 0:
-            df, total_records = req_first_page(selected_searchable, set_ids)
-
         # determine search string
-        search_string = " [AND] ".join(["`{0}`".format(a.AttributeName) for a in st.session_state.attributes_list
-                                        if a.AttributeId in selected_searchable])
+        search_string = " [AND] ".join(["`{0}`".format(a.AttributeName) for a in [x_sub_attribute, y_sub_attribute]])
+
+        df = None
+        if st.session_state.get("local_analytics", False):
+            # intersection of the two columns of the incidence matrix
+            item_ids = get_incidence_matrix().drilldown(selected_searchable)
+            df, total_records = local_records(item_ids), len(item_ids)
+        if df is None:
+            # all pages
+            df, total_records = fetch_all_records(selected_searchable, set_ids, search_string)
         st.write("Search:", search_string if search_string else None)
         st.write("Records Found:", total_records)
-        # subsequent pages
-        for i in range(1, ceil(total_records/100)):
-            new_df = req_next_page(i, search_string, selected_searchable, set_ids)
-            df = pd.concat([df, new_df], ignore_index=True)
 
         # display with aggrid
         all_pages.pg_record_view.aggrid_view(df)
@@ -181,7 +199,7 @@ def demo_p4():
     if "display_crosstab" not in st.session_state:
         st.session_state["display_crosstab"] = False
     with st.form(key="crosstab_form"):
-        parent_attributes = [a for a in st.session_state.attributes_list if a.HasChildren]
+        parent_attributes = st.session_state.attribute_registry.parents()
         parent_attribute_names = [a.AttributeName for a in parent_attributes]
         col1, col2 = st.columns(2)
         with col1:
@@ -210,7 +228,10 @@ def demo_p4():
 
     if st.session_state.display_crosstab:
         # crosstab dataframe
-        df = req_crosstab(attribute_1, attribute_2)
+        if st.session_state.get("local_analytics", False):
+            df = local_crosstab(attribute_1, attribute_2)
+        else:
+            df = req_crosstab(attribute_1, attribute_2)
 
         st.write("##### Overview")
         _, overview_col, _ = st.columns(3)
@@ -223,4 +244,4 @@ def demo_p4():
             st.write(fig)
 
         st.write("#####", attribute_1.AttributeName, "x", attribute_2.AttributeName)
-        aggrid_view(df, attribute_1.AttributeName, attribute_2.AttributeName)
+        aggrid_view(df, attribute_1, attribute_2)
@@ -8,7 +8,18 @@ import streamlit as st
 from all_pages.pg_record_view import aggrid_view
 from annotated_text import annotated_text, annotation
 from api_calls import *
+from id_sets import (
+    EMPTY_IDS,
+    apply_operator,
+    arms_to_fetch,
+    index_records,
+    records_frame,
+)
+from query_parser import QuerySyntaxError
+from response_cache import OfflineCacheMiss
+from search_cache import arm_cache, arm_key, prefix_cache
 from streamlit.components.v1 import html
+from text_index import RECORD_FIELDS
 from utils import *
 
 
@@ -34,18 +45,9 @@ def search_sessionstate_init():
     if "picooptions" not in st.session_state:
         st.session_state.picooptions = {}
         get_all_attributes()
+        prefetch_frequency_counts(st.session_state.attributes_list)
         for attribute in st.session_state.attributes_list:
             if attribute.HasChildren:
-                if (
-                    "{}_{}".format(attribute.AttributeId, attribute.SetId)
-                    not in st.session_state.frequency_counts
-                ):
-                    st.session_state.frequency_counts[
-                        "{}_{}".format(attribute.AttributeId, attribute.SetId)
-                    ] = get_frequency_counts(
-                        attribute.AttributeId, attribute.SetId, included=True
-                    )
-
                 freqs = st.session_state.frequency_counts[
                     "{}_{}".format(attribute.AttributeId, attribute.SetId)
                 ]
@@ -70,9 +72,102 @@ def search_sessionstate_init():
 
         # st.session_state.picooptions['CodeB']=sorted(["BA", "BB", "BX", "BC", ])
         # st.session_state.picooptions['CodeC']=sorted(["hello", "testBB", "BX", "BC", ])
+    if "arm_counts" not in st.session_state:
+        st.session_state.arm_counts = []
     # st.write(st.session_state.attributes_list)
 
 
+def resolve_arm(sd):
+    """
+    The attributes (to be OR'd together) and the free-text query of a search
+    arm of the query builder.
+    """
+    selected_attributes = []
+    myquery = ""
+    for entry in sd:
+        if entry[1] == "Free Text Query":
+            myquery = entry[0]
+        elif isinstance(entry, tuple):
+            parentcode_name = entry[1]
+            this_name = entry[0]
+            this_parent = st.session_state.picooptions[parentcode_name][1]
+            attribute = st.session_state.attribute_registry.find(
+                this_name, this_parent.AttributeId
+            )
+            if attribute is not None:
+                selected_attributes.append(attribute)
+    return selected_attributes, myquery
+
+
+def arm_count(sd):
+    """
+    Upper bound of the number of records a search arm finds, from count-only
+    requests; None if its query is invalid or, offline, if the counts are
+    not cached.
+    """
+    selected_attributes, myquery = resolve_arm(sd)
+    try:
+        if len(selected_attributes) > 0:
+            return codes_count(selected_attributes)
+        if len(myquery) > 0:
+            return textquery_count(myquery)
+    except QuerySyntaxError:
+        return None
+    except OfflineCacheMiss:
+        st.warning("Offline: the record counts of this arm are not cached.")
+        return None
+    return 0
+
+
+def pushdown_search(fetch, record_store):
+    """
+    Run the code arms of the leading AND/NOT run of the search (the arms up
+    to the first OR, which can be evaluated in any order) as one server-side
+    with/without search, see conjunction_ids.
+
+    args:
+        fetch: per arm, whether it needs to be fetched (see arms_to_fetch)
+        record_store: itemId -> record, filled with the fetched records
+
+    returns:
+        itemIds of the pushed down arms (None if nothing was pushed down),
+        indices of the pushed down arms, lines for the search documentation
+    """
+    operators = st.session_state.operators
+    run_end = 1
+    while run_end < len(operators) and operators[run_end] in ("AND", "NOT"):
+        run_end += 1
+    run = range(min(run_end, len(st.session_state.searchdoc)))
+    if not all(fetch[i] for i in run):
+        # the counts already settle this part of the search
+        return None, [], []
+
+    with_groups, without_atts, pushed, names = [], [], [], []
+    for i in run:
+        selected_attributes, myquery = resolve_arm(st.session_state.searchdoc[i])
+        if len(selected_attributes) == 0:
+            continue
+        pushed.append(i)
+        arm_name = " OR ".join(a.AttributeName for a in selected_attributes)
+        if i > 0 and operators[i] == "NOT":
+            without_atts.extend(selected_attributes)
+            names.append("NOT <{}>".format(arm_name))
+        else:
+            with_groups.append(selected_attributes)
+            names.append(("AND <{}>" if names else "<{}>").format(arm_name))
+
+    if len(with_groups) == 0 or len(pushed) < 2:
+        return None, [], []
+    ids, n_requests = conjunction_ids(with_groups, without_atts, record_store)
+    info = [
+        "\n\n>>> ARMS {} (server-side):".format(", ".join(str(i + 1) for i in pushed)),
+        "Searched {} in {} requests and retrieved {} results".format(
+            " ".join(names), n_requests, len(ids)
+        ),
+    ]
+    return ids, pushed, info
+
+
 def year_filtering():
     yearfilter = st.toggle(
         "Add Publication Year Filter (Toy function)",
@@ -143,6 +238,7 @@ def boolsearcher():
         st.session_state.multiselect = []
         st.session_state.picogroups = []
         st.session_state.searchdoc = []
+        st.session_state.arm_counts = []
         st.session_state.operators = []
         st.session_state.this_operator = ""
         st.session_state.submitted = False
@@ -156,6 +252,10 @@ def boolsearcher():
         st.session_state.operators.append("OR")
         add_pico()
 
+    def add_not():
+        st.session_state.operators.append("NOT")
+        add_pico()
+
     def add_empty():
         st.session_state.operators.append("")
         add_pico()
@@ -217,9 +317,13 @@ def boolsearcher():
             st.session_state.searchdoc.append(thislist)
             # st.session_state.searchdoc.append("{}: {}".format(picooption, " OR ".join(st.session_state.multiselect)))
             clear_multi()
+        if len(st.session_state.arm_counts) < len(st.session_state.searchdoc):
+            st.session_state.arm_counts.append(
+                arm_count(st.session_state.searchdoc[-1])
+            )
         return
 
-    col1, col1b, col2, col3 = st.columns(4)
+    col1, col1b, col1c, col2, col3 = st.columns(5)
 
     def submission():
         st.session_state.submitted = True
@@ -231,6 +335,9 @@ def boolsearcher():
         with col1b:
             st.button("Add as OR", on_click=add_or)
 
+        with col1c:
+            st.button("Add as NOT", on_click=add_not)
+
         with col2:
             st.button("Submit search", on_click=submission, type="primary")
 
@@ -240,6 +347,13 @@ def boolsearcher():
 
     with col3:
         st.button("⚠️Delete this search", on_click=clear_all)
+        st.toggle(
+            "Server-side AND/NOT",
+            value=True,
+            key="pushdown",
+            help="Send code arms joined by AND/NOT to the server as one search "
+            "instead of downloading and intersecting every arm",
+        )
 
         ##################################################################
 
@@ -249,16 +363,29 @@ def boolsearcher():
                 annotated_text(annotation("AND", "", "#faf", border="2px dashed red"))
             elif st.session_state.operators[i] == "OR":
                 annotated_text(annotation("OR", "", "#24dde0", border="2px dashed red"))
+            elif st.session_state.operators[i] == "NOT":
+                annotated_text(annotation("NOT", "", "#fdd835", border="2px dashed red"))
         annotated_text(sd)
+        if i < len(st.session_state.arm_counts):
+            if st.session_state.arm_counts[i] is None:
+                st.caption("Invalid query, this arm will find no records")
+            else:
+                st.caption("up to {} records".format(st.session_state.arm_counts[i]))
     with st.expander("View structured query", expanded=False):
         st.write(st.session_state.operators)
         st.divider()
         st.write(st.session_state.searchdoc)
 
 
-    @st.cache_data
-    def search_all(this_searchdoc):
-        dfs = []
+    def search_all(this_searchdoc, pushdown=True):
+        # each arm is reduced to a sorted array of itemIds and combined with the
+        # previous arms by set operations; records are kept once per itemId and
+        # only the final set is turned into a df. With pushdown, the code arms
+        # of the leading AND/NOT run are answered by the server in one search.
+        # Results of single arms and of every prefix of arms are memoised in
+        # search_cache, so adding an arm only evaluates the new arm
+        record_store = {}
+        result_ids = None
         now = datetime.datetime.now()
         progress_bar = st.progress(0)
         status_text = st.empty()
@@ -270,45 +397,89 @@ def boolsearcher():
         ]
         # st.code(searchinfo[-1], language="markdown")
 
-        for i, sd in enumerate(st.session_state.searchdoc):  # for each arm
-            progress = (i + 1) / len(st.session_state.searchdoc)
+        if len(st.session_state.arm_counts) != len(this_searchdoc):
+            st.session_state.arm_counts = [arm_count(sd) for sd in this_searchdoc]
+        counts = st.session_state.arm_counts
+        fetch = arms_to_fetch(counts, st.session_state.operators)
+
+        arms = [resolve_arm(sd) for sd in this_searchdoc]
+        # code arms are fully paged whether or not they are pushed down, so
+        # both modes give the same results and share prefixes
+        keys = [
+            (st.session_state.operators[i] if i > 0 else "", arm_key(*arm))
+            for i, arm in enumerate(arms)
+        ]
+        start, cached = prefix_cache.longest_prefix(keys)
+        pushed = []
+        if cached is not None:
+            result_ids, records, cached_info = cached
+            record_store.update(records)
+            searchinfo.extend(cached_info)
+            searchinfo.append("\n(Reused the results of arms 1 to {})".format(start))
+        elif pushdown:
+            try:
+                result_ids, pushed, info = pushdown_search(fetch, record_store)
+                searchinfo.extend(info)
+            except OfflineCacheMiss:
+                # evaluate the arms one by one, as far as they are cached
+                searchinfo.append("\nOffline: the server-side search is not cached")
+        # whether result_ids is exactly the result of the arms so far; it is not
+        # while arms of the pushed down run or arms skipped because of a later
+        # empty AND arm (see arms_to_fetch) are outstanding
+        exact = True
+
+        for i in range(start, len(this_searchdoc)):  # for each arm
+            progress = (i + 1) / len(this_searchdoc)
             progress_bar.progress(progress)
-            status_text.text(
-                f"Processing arm {i + 1} of {len(st.session_state.searchdoc)}"
-            )
+            status_text.text(f"Processing arm {i + 1} of {len(this_searchdoc)}")
 
             searchinfo.append("\n\n>>> ARM {}:".format(i + 1))
             # st.code(searchinfo[-1], language="markdown")
 
             st.session_state.search_info_retrieval = []
 
-            selected_attributes = []  # stor attributes to be OR'd together
-            for entry in sd:
-                if entry[1] == "Free Text Query":
-                    myquery = entry[0]
-                elif isinstance(entry, tuple):
-                    # print(type(entry))
-                    # print(entry)
-                    # print("Name "+ entry[1])
-                    # print("---")
-                    # print(st.session_state.picooptions)
-                    parentcode_name = entry[1]
-                    this_name = entry[0]
-                    this_parent = st.session_state.picooptions[parentcode_name][1]
-                    for attribute in st.session_state.attributes_list:
-                        if (
-                            attribute.AttributeName == this_name
-                            and attribute.ParentAttributeId == this_parent.AttributeId
-                        ):
-                            selected_attributes.append(attribute)
-                            print(
-                                "Successfully identified parent for {}".format(
-                                    this_name
-                                )
-                            )
-
-            if len(selected_attributes) > 0:
-                current_arm = id_retrieval(selected_attributes)
+            selected_attributes, myquery = arms[i]
+            # arms that were not pushed down are ANDed/NOTed onto the pushed
+            # down ones, which is what the leading run does in any order
+            operator = st.session_state.operators[i] if i > 0 else "AND"
+            if counts[i] == 0 and operator == "AND":
+                exact = True
+            elif not fetch[i] and counts[i] != 0:
+                exact = False
+
+            cached_arm = arm_cache.get(keys[i][1])
+            if i in pushed:
+                searchinfo.append("Included in the server-side search")
+                arm_ids = None
+            elif not fetch[i] or (
+                result_ids is not None
+                and len(result_ids) == 0
+                and operator in ("AND", "NOT")
+            ):
+                # the counts tell us this arm cannot change the result
+                arm_ids = EMPTY_IDS
+                searchinfo.append(
+                    "Skipped retrieval, this arm cannot change the results"
+                )
+            elif cached_arm is not None:
+                arm_ids, records = cached_arm
+                record_store.update(records)
+                searchinfo.append("Reused the results of an earlier search")
+            elif len(selected_attributes) > 0:
+                try:
+                    arm_ids = index_records(
+                        records_for_codes(selected_attributes), record_store
+                    )
+                    arm_cache.put(keys[i][1], arm_ids, record_store)
+                except OfflineCacheMiss:
+                    arm_ids = EMPTY_IDS
+                    exact = False
+                    st.warning(
+                        "Offline: the records of arm {} are not cached.".format(i + 1)
+                    )
+                    searchinfo.append(
+                        "Warning: offline, the records of this arm are not cached"
+                    )
                 for indx, sir in enumerate(st.session_state.search_info_retrieval):
                     searchinfo.append(
                         "Searched <{}> and retreived {} results".format(
@@ -319,40 +490,58 @@ def boolsearcher():
 
             else:
                 if len(myquery) > 0:
-                    myfield = "TitleAbstract"
-                    current_arm = refs_per_textsearch(field=myfield, query=myquery)
-                    searchinfo.append(
-                        "Searched query <{}> on field <{}> and retrieved {} results".format(
-                            myquery, myfield, current_arm.shape[0]
+                    try:
+                        arm_ids, plan = textquery_ids(myquery, record_store)
+                        arm_cache.put(keys[i][1], arm_ids, record_store)
+                        searchinfo.append(
+                            "Searched query <{}> as <{}> and retrieved {} results".format(
+                                myquery, plan, len(arm_ids)
+                            )
+                        )
+                    except QuerySyntaxError as e:
+                        arm_ids = EMPTY_IDS
+                        st.error("Could not run query <{}>: {}".format(myquery, e))
+                        searchinfo.append(
+                            "Warning: query <{}> is invalid: {}".format(myquery, e)
+                        )
+                    except OfflineCacheMiss:
+                        arm_ids = EMPTY_IDS
+                        exact = False
+                        st.warning(
+                            "Offline: the results of query <{}> are not cached.".format(
+                                myquery
+                            )
+                        )
+                        searchinfo.append(
+                            "Warning: offline, query <{}> is not cached".format(myquery)
                         )
-                    )
 
                 else:
+                    arm_ids = EMPTY_IDS
                     searchinfo.append(
                         "Warning: No Attribute and no queries found for this search"
                     )
 
-            dfs.append(current_arm)
-            # searchinfo.append(">>> query: {}".format(" [OR] ".join([a.AttributeName for a in selected_attributes])))
-            searchinfo.append("\n{} results for this arm.".format(dfs[-1].shape[0]))
-            # st.code(searchinfo[-1], language="markdown")
-            if len(dfs) > 1:
-                if (
-                    st.session_state.operators[i] == "AND"
-                ):  # keep records for which item ids are in both dfs
-                    source = dfs[0]
-                    target = dfs[1]
-                    dfs = [source[source["itemId"].isin(target["itemId"])]]
-                else:  # merge all items and remove duplicates only
-                    merged = pd.concat(dfs)
-                    merged = merged.drop_duplicates(subset=["itemId"], keep="first")
-                    dfs = [merged]
-                searchinfo.append(
-                    "\nUsing [{}]: <{}> aggregated results between this and the previous arm.".format(
-                        st.session_state.operators[i], dfs[0].shape[0]
+            if arm_ids is not None:
+                # searchinfo.append(">>> query: {}".format(" [OR] ".join([a.AttributeName for a in selected_attributes])))
+                searchinfo.append("\n{} results for this arm.".format(len(arm_ids)))
+                # st.code(searchinfo[-1], language="markdown")
+                if result_ids is None:
+                    result_ids = arm_ids
+                else:
+                    # AND: keep ids in both, OR: union, NOT: drop ids of this arm
+                    result_ids = apply_operator(result_ids, [arm_ids], operator)
+                    searchinfo.append(
+                        "\nUsing [{}]: <{}> aggregated results between this and the previous arm.".format(
+                            operator, len(result_ids)
+                        )
                     )
+                    # st.code(searchinfo[-1], language="markdown")
+
+            if exact and (len(pushed) == 0 or i >= max(pushed)):
+                prefix_cache.put(
+                    tuple(keys[: i + 1]), result_ids, record_store, searchinfo[1:]
                 )
-                # st.code(searchinfo[-1], language="markdown")
         status_text.text("Done! ✅")
         st.code("\n".join(searchinfo), language="markdown")
         st.divider()
@@ -362,10 +551,12 @@ def boolsearcher():
         )
         st.markdown("## Search Results")
 
-        return dfs[0]
+        # text arms answered by the text index only hold its RECORD_FIELDS, so
+        # every result is projected to them
+        return records_frame(result_ids, record_store, RECORD_FIELDS)
 
     if st.session_state.submitted:
-        outdf = search_all(st.session_state.searchdoc)
+        outdf = search_all(st.session_state.searchdoc, st.session_state.pushdown)
 
         downloader(outdf)
         # with st.popover("Download", icon=":material/download:"):
@@ -1,8 +1,6 @@
-from math import ceil
-
 import pandas as pd
 import streamlit as st
-from api_calls import req_first_page, req_next_page
+from api_calls import fetch_all_records
 from st_aggrid import AgGrid, GridOptionsBuilder, JsCode
 from streamlit_tree_select import tree_select
 from utils import downloader
@@ -117,40 +115,27 @@ def view_records():
         filter_status = tree_select(st.session_state.treestructures)
 
     # ignore top-level attributes (they are not searchable)
-    selected_searchable = [
-        int(x)
-        for x in filter_status["checked"]
-        if int(x)
-        in [
-            a.AttributeId for a in st.session_state.attributes_list if not a.HasChildren
-        ]
-    ]
-    set_ids = [
-        a.SetId
-        for a in st.session_state.attributes_list
-        if a.AttributeId in selected_searchable
-    ]
+    registry = st.session_state.attribute_registry
+    checked = [registry.get(int(x)) for x in filter_status["checked"]]
+    selected_attributes = [a for a in checked if a is not None and not a.HasChildren]
+    selected_searchable = [a.AttributeId for a in selected_attributes]
+    set_ids = [a.SetId for a in selected_attributes]
+
+    # determine search string
+    search_string = " [AND] ".join(
+        ["`{0}`".format(a.AttributeName) for a in selected_attributes]
+    )
 
     total_records = 0
     df = pd.DataFrame()
-    # first page
+    # all pages
     if len(selected_searchable) > 0:
-        df, total_records = req_first_page(selected_searchable, set_ids)
+        df, total_records = fetch_all_records(
+            selected_searchable, set_ids, search_string
+        )
 
-    # determine search string
-    search_string = " [AND] ".join(
-        [
-            "`{0}`".format(a.AttributeName)
-            for a in st.session_state.attributes_list
-            if a.AttributeId in selected_searchable
-        ]
-    )
     st.write("Search:", search_string if search_string else None)
     st.write("Records Found:", total_records)
-    # subsequent pages
-    for i in range(1, ceil(total_records / 100)):
-        new_df = req_next_page(i, search_string, selected_searchable, set_ids)
-        df = pd.concat([df, new_df], ignore_index=True)
 
     # display with aggrid
     downloader(df)
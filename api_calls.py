@@ -1,120 +1,274 @@
+import hashlib
+import json
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from itertools import product
+from math import ceil
 from typing import List
 
 import numpy as np
 import pandas as pd
 import streamlit as st
-from data_definitions import Attribute
+from data_definitions import Attribute, AttributeRegistry
+from eppi_client import RESPONSE_CACHE_TTL, RETRY_ERRORS, EppiVisClient
+from id_sets import EMPTY_IDS, and_ids, index_records, not_ids, or_ids
+from incidence import IncidenceMatrix, YearCube, parse_year
+from query_parser import (
+    cardinality_estimator,
+    execute_query,
+    parse_query,
+    plan_query,
+)
+from response_cache import OfflineCacheMiss, get_response_cache
+from text_index import get_text_index
+
+# bounds for concurrent frequency count requests (see prefetch_frequency_counts)
+FREQUENCY_MAX_WORKERS = 8
+FREQUENCY_TIMEOUT = 30  # seconds, per request
+# seconds before the process-wide codeset is revalidated against the server
+CODESET_TTL = 15 * 60
+# record lists are served in pages of this size
+RECORDS_PAGE_SIZE = 100
+# bound for concurrent record list requests (see fetch_all_records, id_retrieval)
+RECORDS_MAX_WORKERS = 8
+# bound for the requests one AND/NOT search is distributed over (see conjunction_ids)
+PUSHDOWN_MAX_REQUESTS = 16
+# seconds an offline text search waits for the text index to be filled from
+# the response cache (see use_text_index)
+OFFLINE_SYNC_TIMEOUT = 60
+
+
+def parse_codesets(data):
+    """
+    Parse the codesets of a ReviewSetList/FetchJSON response in a single pass.
+
+    Walks all sets iteratively (explicit stack, so deep hierarchies don't hit
+    the recursion limit) and emits both representations we need at once.
 
+    args:
+        data: list of codesets as returned by FetchJSON
 
-def build_nested_structure(attributes_list):
-    nodes = []
-    for attr in attributes_list:
-        label = attr.get("attributeName", "").strip()
-        value = str(attr.get("attributeId"))  # convert to string for consistency
+    returns:
+        - attributes: flat list of Attribute objects, in depth-first order
+        - treestructures: nested {"label", "value", "children"} nodes of all
+        sets, as used by the tree widgets
+    """
+    attributes = []
+    treestructures = []
+
+    # (attribute json, parent id, list the tree node is appended to); pushed in
+    # reverse so that siblings are popped, and hence appended, in order
+    stack = []
+    for codeset in reversed(data):
+        top_level_attrs = codeset.get("attributes", {}).get("attributesList", [])
+        for attr in reversed(top_level_attrs):
+            stack.append((attr, None, treestructures))
+
+    while stack:
+        attr, parent_id, siblings = stack.pop()
         nested = attr.get("attributes", {}).get("attributesList", [])
+        has_children = bool(nested)
 
-        node = {"label": label, "value": value}
+        # names and set descriptions repeat across sessions and codes, so intern them
+        this_attribute = Attribute(
+            AttributeName=sys.intern(attr.get("attributeName", "").strip()),
+            AttributeId=attr.get("attributeId"),
+            ParentAttributeId=attr.get("parentAttributeId", parent_id),
+            SetId=attr.get("setId"),
+            AttributeSetDescription=sys.intern(
+                attr.get("attributeSetDescription", "").strip()
+            ),
+            HasChildren=has_children,
+        )
+        attributes.append(this_attribute)
+
+        # convert value to string for consistency
+        node = {
+            "label": this_attribute.AttributeName,
+            "value": str(attr.get("attributeId")),
+        }
+        siblings.append(node)
 
-        if nested:
-            node["children"] = build_nested_structure(nested)
+        if has_children:
+            node["children"] = []
+            for child in reversed(nested):
+                stack.append((child, attr.get("attributeId"), node["children"]))
 
-        nodes.append(node)
+    return attributes, treestructures
 
-    return nodes
 
+def get_client() -> EppiVisClient:
+    """
+    The EppiVisClient of the current session.
+    """
+    return st.session_state.client
 
-def extract_structure(data, setnr=0):
-    top_level_attrs = data[setnr].get("attributes", {}).get("attributesList", [])
-    # print("Retrieved and stored tree structure.")
-    return build_nested_structure(top_level_attrs)
 
+class Codeset():
+    """
+    The parsed FetchJSON codeset: raw json, flat attribute list, tree structure
+    and registry. One instance is shared by all sessions (see load_codeset),
+    so it must be treated as read-only.
+    """
 
-def parse_attributes(attributes_list, result, parent_id=None):
-    for attr in attributes_list:
-        nested = attr.get("attributes", {}).get("attributesList", [])
-        has_children = bool(nested)
+    def __init__(self, data, content_hash, etag=None, last_modified=None):
+        self.data = data
+        self.content_hash = content_hash
+        self.etag = etag
+        self.last_modified = last_modified
+        self.checked_at = time.monotonic()
 
-        this_attribute = Attribute()
-        this_attribute.AttributeName = attr.get("attributeName", "").strip()
-        this_attribute.AttributeId = attr.get("attributeId")
-        this_attribute.ParentAttributeId = attr.get("parentAttributeId", parent_id)
-        this_attribute.SetId = attr.get("setId")
-        this_attribute.AttributeSetDescription = attr.get(
-            "attributeSetDescription", ""
-        ).strip()
-        this_attribute.HasChildren = has_children
-        result.append(this_attribute)
-
-        # recursively parse nested attributes
-        if has_children:
-            parse_attributes(nested, result, parent_id=attr.get("attributeId"))
+        self.attributes, self.treestructures = parse_codesets(data)
+        self.registry = AttributeRegistry(self.attributes)
 
 
-def extract_all_attributes(data, setnr=0):
-    all_attributes = []
-    top_level_attrs = data[setnr].get("attributes", {}).get("attributesList", [])
-    parse_attributes(top_level_attrs, all_attributes)
-    return all_attributes
+class _CodesetCache():
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.codeset = None
+
+
+@st.cache_resource
+def _codeset_cache():
+    """
+    Process-wide holder of the current Codeset, shared by all sessions.
+    """
+    return _CodesetCache()
+
+
+def load_codeset(client: EppiVisClient, ttl: float = CODESET_TTL) -> Codeset:
+    """
+    Return the process-wide Codeset, downloading and parsing it only if there
+    is none yet or it is older than ttl seconds. Revalidation sends
+    If-None-Match / If-Modified-Since when the server gave us an ETag or
+    Last-Modified header; a 304, or an unchanged body, keeps the parsed
+    codeset. Concurrent callers wait for the one download in flight.
+    """
+    cache = _codeset_cache()
+    with cache.lock:
+        codeset = cache.codeset
+        if codeset is not None and time.monotonic() - codeset.checked_at < ttl:
+            return codeset
+
+        # cold start: a new process picks up the codeset from the response cache
+        response_cache = get_response_cache()
+        key = response_cache.key("GET", "ReviewSetList/FetchJSON")
+        if codeset is None:
+            text = response_cache.get(key, ttl)
+            if text is not None:
+                cache.codeset = Codeset(
+                    json.loads(text), hashlib.sha1(text.encode("utf-8")).hexdigest()
+                )
+                return cache.codeset
+            if response_cache.offline:
+                raise OfflineCacheMiss("GET ReviewSetList/FetchJSON")
+        elif response_cache.offline:
+            return codeset
+
+        headers = {}
+        if codeset is not None and codeset.etag:
+            headers["If-None-Match"] = codeset.etag
+        if codeset is not None and codeset.last_modified:
+            headers["If-Modified-Since"] = codeset.last_modified
+
+        try:
+            req = client.request("GET", "ReviewSetList/FetchJSON", headers=headers)
+            if codeset is not None and req.status_code == 304:
+                codeset.checked_at = time.monotonic()
+                return codeset
+            req.raise_for_status()
+        except RETRY_ERRORS:
+            # a failed revalidation keeps the codeset we have; without one
+            # there is nothing to fall back to
+            if codeset is not None:
+                return codeset
+            raise
+
+        response_cache.put(key, "ReviewSetList/FetchJSON", req.text)
+        content_hash = hashlib.sha1(req.text.encode("utf-8")).hexdigest()
+        if codeset is not None and codeset.content_hash == content_hash:
+            codeset.checked_at = time.monotonic()
+            return codeset
+
+        cache.codeset = Codeset(
+            req.json(),
+            content_hash,
+            etag=req.headers.get("ETag"),
+            last_modified=req.headers.get("Last-Modified"),
+        )
+        return cache.codeset
 
 
 def get_all_attributes(return_list: bool = False):
     """
     if return_list, return the list as an object as well
     as saving to session state
-    """
-    req = st.session_state.session.get(
-        "https://eppi.ioe.ac.uk/eppi-vis/ReviewSetList/FetchJSON",
-        cookies={"WebDbErLoginCookie": st.session_state.cookie},
-    )
-    attribute_list = req.json()
 
+    The codeset comes from the process-wide cache (load_codeset), so sessions
+    that already hold their attributes don't trigger any request.
+    """
     # update attribute list only once at the start, or when specifically requested
     if (
         "attributes_list" not in st.session_state
         and "treestructures" not in st.session_state
     ):
-        st.session_state.attributes_list = []
-        st.session_state.treestructures = []
-
-        for i, _ in enumerate(attribute_list):
-            attribute_data = extract_all_attributes(attribute_list, i)
-            st.session_state.treestructures = extract_structure(attribute_list, i)
-            st.session_state.attributes_list.extend(attribute_data)
+        codeset = load_codeset(get_client())
+        st.session_state.attributes_list = codeset.attributes
+        st.session_state.treestructures = codeset.treestructures
+        st.session_state.attribute_registry = codeset.registry
+    elif return_list:
+        codeset = load_codeset(get_client())
 
     # st.write(attribute_list)
 
     if return_list:
-        return attribute_list
+        return codeset.data
 
     # print("Retrieved and stored attributes.")
 
 
-def get_frequency_counts(attId: int, setId: int, included: bool = True):
+def _fan_out(func, args_list, max_workers):
     """
-    Retrieve frequency counts for a specific attribute
-    :param attId: int
-    :param setId: int
-    :param included: bool
-    :return: dict
+    Run func(*args) for every tuple in args_list on a bounded thread pool.
+    Results are returned in the order of args_list; the first exception raised
+    by a worker is re-raised here.
     """
+    if len(args_list) == 0:
+        return []
+    n_workers = max(1, min(max_workers, len(args_list)))
+    with ThreadPoolExecutor(max_workers=n_workers) as pool:
+        return list(pool.map(lambda args: func(*args), args_list))
 
-    df = pd.DataFrame()
-    codes = []
-    counts = []
-    ids = []
-    sets = []
 
+def _request_frequency_counts(client, attId, setId, included=True, timeout=None):
+    """
+    POST to Frequencies/GetFrequenciesJSON and return the raw result entries.
+    Takes the client explicitly so it can run outside the Streamlit script
+    thread.
+    """
     payload = {"attId": attId, "setId": setId, "included": included}
     # headers = {
     #     "Content-Type": "application/json"
     # }
 
-    req = st.session_state.session.post(
-        "https://eppi.ioe.ac.uk/eppi-vis/Frequencies/GetFrequenciesJSON",
-        data=payload,
-        cookies={"WebDbErLoginCookie": st.session_state.cookie},
+    res = client.request_json(
+        "POST", "Frequencies/GetFrequenciesJSON", payload, timeout=timeout
     )
-    my_attributes = req.json().get("results", [])
+    return res.get("results", [])
+
+
+def _frequency_df(my_attributes) -> pd.DataFrame:
+    """
+    Build the frequency counts df (Codes, Counts, attId, setId) from the
+    result entries of GetFrequenciesJSON.
+    """
+    df = pd.DataFrame()
+    codes = []
+    counts = []
+    ids = []
+    sets = []
 
     for entry in my_attributes:
         if entry["attributeId"] > 0:
@@ -131,145 +285,243 @@ def get_frequency_counts(attId: int, setId: int, included: bool = True):
     return df
 
 
-def clean_dedupe_attributes(df: pd.DataFrame) -> pd.DataFrame:
+def get_frequency_counts(attId: int, setId: int, included: bool = True):
     """
-    NOTE: moved to API_calls from utils.
+    Retrieve frequency counts for a specific attribute
+    :param attId: int
+    :param setId: int
+    :param included: bool
+    :return: dict
+    """
+    if st.session_state.get("local_analytics", False) and included:
+        return local_frequency_counts(attId, setId)
+    my_attributes = _request_frequency_counts(
+        get_client(),
+        attId,
+        setId,
+        included=included,
+        timeout=FREQUENCY_TIMEOUT,
+    )
+    return _frequency_df(my_attributes)
+
+
+def prefetch_frequency_counts(
+    attributes: List[Attribute],
+    max_workers: int = FREQUENCY_MAX_WORKERS,
+    timeout: float = FREQUENCY_TIMEOUT,
+):
+    """
+    Fetch the frequency counts of all parent attributes that are not yet in
+    st.session_state.frequency_counts in one concurrent fan-out, instead of
+    one blocking request after the other.
 
-    cleans the attributes df for plotting.
+    args:
+        attributes: attributes to consider, those without children are skipped
+        max_workers: maximum number of requests in flight at once
+        timeout: timeout in seconds for each single request
     """
-    # Step 1: Make 'character' entries unique by appending 'parent' if duplicates exist
-    duplicates = df["character"].duplicated(keep=False)
-    df["character"] = df.apply(
-        lambda row: f"{row['character']} ({row['parent']})"
-        if duplicates[row.name] and row["parent"] != ""
-        else row["character"],
-        axis=1,
+    missing = {}
+    for attribute in attributes:
+        key = "{}_{}".format(attribute.AttributeId, attribute.SetId)
+        if attribute.HasChildren and key not in st.session_state.frequency_counts:
+            missing[key] = attribute
+
+    if st.session_state.get("local_analytics", False):
+        for key, a in missing.items():
+            st.session_state.frequency_counts[key] = local_frequency_counts(
+                a.AttributeId, a.SetId
+            )
+        return
+
+    # worker threads have no Streamlit script context, so read session state here
+    client = get_client()
+    results = _fan_out(
+        _request_frequency_counts,
+        [(client, a.AttributeId, a.SetId, True, timeout) for a in missing.values()],
+        max_workers,
     )
+    for key, my_attributes in zip(missing, results):
+        st.session_state.frequency_counts[key] = _frequency_df(my_attributes)
 
-    # Step 2: Build mapping of each parent to the sum of its children's values
-    value_sums = df.groupby("parent")["value"].sum()
 
-    # Step 3: Add own value only if character is not referenced as a parent anywhere
-    df["new_value"] = df["character"].map(value_sums).fillna(0)
-    not_in_parent = ~df["character"].isin(df["parent"].dropna().unique())
-    df.loc[not_in_parent, "new_value"] += df.loc[not_in_parent, "value"]
+@st.cache_resource(
+    ttl=RESPONSE_CACHE_TTL, show_spinner="Building the local incidence matrix..."
+)
+def _build_incidence_matrix(content_hash, _client, _attributes) -> IncidenceMatrix:
+    """
+    Incidence matrix of all attributes of a codeset (identified by its
+    content hash), from all pages of the records of every attribute (see
+    _fetch_all_pages, which also adds them to the text index), attributes
+    requested concurrently. The publication years of the fetched records
+    are kept with it, for the YearCube. Shared by all sessions; rebuilt
+    after RESPONSE_CACHE_TTL so new coding shows up.
+    """
+    record_lists = _fan_out(
+        lambda a: _fetch_all_pages(_client, [a.AttributeId], [a.SetId])[0],
+        [(a,) for a in _attributes],
+        RECORDS_MAX_WORKERS,
+    )
+    years = {
+        record["itemId"]: parse_year(record.get("year"))
+        for records in record_lists
+        for record in records
+    }
+    return IncidenceMatrix(
+        [a.AttributeId for a in _attributes],
+        [[record["itemId"] for record in records] for records in record_lists],
+        years,
+    )
 
-    # Step 4: Replace 'value' with the updated values
-    df["value"] = df["new_value"].astype(int)
-    df.drop(columns=["new_value"], inplace=True)
 
-    return df
+def get_incidence_matrix() -> IncidenceMatrix:
+    """
+    The item x attribute incidence matrix of the current codeset, built on
+    first use.
+    """
+    client = get_client()
+    codeset = load_codeset(client)
+    return _build_incidence_matrix(codeset.content_hash, client, codeset.attributes)
 
 
-def attributes_to_hierarchical(clean: bool = True) -> pd.DataFrame:
+@st.cache_resource(ttl=RESPONSE_CACHE_TTL)
+def _build_year_cube(content_hash, _matrix) -> YearCube:
     """
-    produces a pandas df (required for producing plots
-    with plotly) from the processed attributes retrieved
-    from the API.
+    YearCube of the incidence matrix of a codeset, with the years of the
+    records the matrix was built from.
+    """
+    return YearCube(_matrix, _matrix.item_years)
 
-    args:
-        clean: bool, whether to run clean_dedupe_attributes
 
-    returns:
-        df of attributes
+def get_year_cube() -> YearCube:
     """
-    sunburst_data = []
+    The attribute x year count cube of the current codeset, built on first
+    use (together with the incidence matrix, if needed). Only used with
+    local analytics on: building it pages through the records of every code.
+    """
+    codeset = load_codeset(get_client())
+    return _build_year_cube(codeset.content_hash, get_incidence_matrix())
 
-    id_to_name = {
-        att.AttributeId: att.AttributeName for att in st.session_state.attributes_list
-    }
 
-    for attribute in st.session_state.attributes_list:
-        if attribute.HasChildren:
-            if (
-                "{}_{}".format(attribute.AttributeId, attribute.SetId)
-                not in st.session_state.frequency_counts
-            ):
-                st.session_state.frequency_counts[
-                    "{}_{}".format(attribute.AttributeId, attribute.SetId)
-                ] = get_frequency_counts(
-                    attribute.AttributeId, attribute.SetId, included=True
-                )
+def local_frequency_counts(attId: int, setId: int) -> pd.DataFrame:
+    """
+    Frequency counts of the children of an attribute (or of the top level
+    codes of set setId for attId 0), as get_frequency_counts returns them,
+    computed as column sums of the incidence matrix.
+    """
+    children = [
+        a
+        for a in st.session_state.attribute_registry.children(attId)
+        if a.SetId == setId
+    ]
+    counts = get_incidence_matrix().frequencies([a.AttributeId for a in children])
+    df = pd.DataFrame()
+    df["Codes"] = [a.AttributeName for a in children]
+    df["Counts"] = counts
+    df["attId"] = [a.AttributeId for a in children]
+    df["setId"] = [a.SetId for a in children]
+    return df
 
-    for att in st.session_state.attributes_list:
-        current_id = att.AttributeId
-        current_name = att.AttributeName
-        parent_id = att.ParentAttributeId
 
-        parent_name = id_to_name.get(parent_id, "") if parent_id != 0 else ""
+def local_records(item_ids):
+    """
+    df of the records of the given itemIds, from the local text index; None
+    if the (bounded) index does not hold all of them.
+    """
+    index = get_text_index()
+    item_ids = np.asarray(item_ids).tolist()
+    if not all(i in index for i in item_ids):
+        return None
+    return pd.DataFrame([index.record(i) for i in item_ids])
 
-        try:
-            freqs = st.session_state.frequency_counts[
-                "{}_{}".format(parent_id, attribute.SetId)
-            ]
 
-            sunburst_data.append(
-                {
-                    "character": current_name,
-                    "parent": parent_name,
-                    "value": freqs.loc[freqs["attId"] == current_id, "Counts"].iloc[0],
-                }
-            )
-        except KeyError as e:
-            # st.write(f"Error type: {type(e).__name__}")
-            # st.write(f"Error message: {str(e)}")
-            sunburst_data.append(
-                {"character": current_name, "parent": parent_name, "value": 0}
-            )
+def hierarchy_df(values, rollup: bool = True) -> pd.DataFrame:
+    """
+    Plot df of all attributes (required for producing hierarchical plots
+    with plotly), keyed on AttributeId/ParentAttributeId instead of display
+    names, so repeated names are no problem.
 
-    df = pd.DataFrame(sunburst_data)
+    args:
+        values: per-attribute values, aligned with st.session_state.attributes_list
+        rollup: bool, whether to replace the values by branch totals
+            (see AttributeRegistry.rollup)
 
-    if clean:
-        df = clean_dedupe_attributes(df)
+    returns:
+        df with the plotly columns ids and parents, the display names
+        character and parent, and value
+    """
+    registry = st.session_state.attribute_registry
+    ids = np.asarray(
+        ["{}_{}".format(a.SetId, a.AttributeId) for a in registry.attributes],
+        dtype=object,
+    )
+    names = np.asarray([a.AttributeName for a in registry.attributes], dtype=object)
+    top_level = registry.parent_rows < 0
+    parent_rows = np.where(top_level, 0, registry.parent_rows)
+
+    return pd.DataFrame(
+        {
+            "ids": ids,
+            "parents": np.where(top_level, "", ids[parent_rows]),
+            "character": names,
+            "parent": np.where(top_level, "", names[parent_rows]),
+            "value": registry.rollup(values) if rollup else np.asarray(values),
+        }
+    )
 
-    return df
 
+def attributes_for_years(cube: YearCube, start: int, end: int, clean: bool = True):
+    """
+    The df of attributes_to_hierarchical, with the values counting only the
+    records published from start to end, read from the year cube.
 
-def add_years_to_attribute_df(
-    df: pd.DataFrame,
-    year_range: list[int] = list(range(2000, 2026)),
-    random_seed: int | None = None,
-) -> pd.DataFrame:
+    args:
+        cube: YearCube of the current codeset
+        start, end: year range, inclusive
+        clean: bool, whether to roll the values up into branch totals
     """
-    appends another column - `year` - to our attributes df,
-    to allow subsetting our plot by a user-specified
-    date range.
+    attributes = st.session_state.attribute_registry.attributes
+    values = cube.counts([att.AttributeId for att in attributes], start, end)
+    return hierarchy_df(values, rollup=clean)
 
-    for now (18/06/25) this will output **FAKE** data
-    in order to experiment with the viz.
 
-    NOTE: replace with real api-derived data.
+def attributes_to_hierarchical(clean: bool = True) -> pd.DataFrame:
+    """
+    produces a pandas df (required for producing plots
+    with plotly) from the processed attributes retrieved
+    from the API.
 
     args:
-        - df: pd.DataFrame returned from attributes_to_hierarchical()
+        clean: bool, whether to roll the values up into branch totals
 
     returns:
-        - attributes_years_df: attribute_df with years column
-        and hence more rows
+        df of attributes (see hierarchy_df)
     """
-    if random_seed is not None:
-        np.random.seed(random_seed)
-
-    new_rows = []
-    n_years = len(year_range)
-
-    for _, row in df.iterrows():
-        # random weights summing to 1
-        random_weights = np.random.dirichlet(np.ones(n_years))
-        distributed_values = row["value"] * random_weights
+    prefetch_frequency_counts(st.session_state.attributes_list)
 
-        for year, dist_value in zip(year_range, distributed_values):
-            new_row = row.copy()
-            new_row["year"] = year
-            new_row["value"] = int(np.floor(dist_value))
-            new_rows.append(new_row)
+    # one attId -> count dict per frequency df instead of a scan per attribute
+    counts = {
+        key: dict(zip(freqs["attId"].tolist(), freqs["Counts"].tolist()))
+        for key, freqs in st.session_state.frequency_counts.items()
+    }
+    values = [
+        counts.get("{}_{}".format(att.ParentAttributeId, att.SetId), {}).get(
+            att.AttributeId, 0
+        )
+        for att in st.session_state.attribute_registry.attributes
+    ]
 
-    attributes_years_df = pd.DataFrame(new_rows)
+    return hierarchy_df(values, rollup=clean)
 
-    return attributes_years_df
 
+def _request_textsearch(
+    client, field, query, page_no=0, page_size=RECORDS_PAGE_SIZE
+):
+    """
+    POST a free-text search to ListFromCritJson.
 
-def refs_per_textsearch(field="TitleAbstract", query="equity"):
+    returns:
+        the records of page page_no and the total number of matching records
+    """
     payload = {
         "onlyIncluded": True,
         "showDeleted": False,
@@ -283,8 +535,8 @@ def refs_per_textsearch(field="TitleAbstract", query="equity"):
         "filterAttributeId": 0,
         "attributeSetIdList": "",
         "listType": "WebDbSearch",
-        "pageNumber": 0,
-        "pageSize": 100,
+        "pageNumber": page_no,
+        "pageSize": page_size,
         "totalItems": 0,
         "startPage": 0,
         "endPage": 0,
@@ -306,68 +558,202 @@ def refs_per_textsearch(field="TitleAbstract", query="equity"):
         "searchWhat": field,
         "searchString": query,
     }
-    headers = {"Content-Type": "application/json"}
+    r4 = client.request_json("POST", "ItemList/ListFromCritJson", payload)
+    items = r4["items"]["items"]
+    return items, r4["items"].get("totalItemCount", len(items))
+
 
-    r4 = st.session_state.session.post(
-        "https://eppi.ioe.ac.uk/eppi-vis/ItemList/ListFromCritJson",
-        data=payload,
-        cookies={"WebDbErLoginCookie": st.session_state.cookie},
+def textsearch_records(field="TitleAbstract", query="equity"):
+    """
+    Records matching a free-text search, as a list of record dicts. All
+    result pages are fetched, the ones after the first concurrently.
+    """
+    client = get_client()
+    refs, total = _request_textsearch(client, field, query)
+    pages = _fan_out(
+        lambda page_no: _request_textsearch(client, field, query, page_no)[0],
+        [(i,) for i in range(1, ceil(total / RECORDS_PAGE_SIZE))],
+        RECORDS_MAX_WORKERS,
     )
-    refs = r4.json()["items"]["items"]
-    refdf = pd.DataFrame(refs)
-    st.session_state.search_info_retrieval.append(refdf.shape[0])
-    return refdf
+    refs = list(refs)
+    for page in pages:
+        refs.extend(page)
+    get_text_index().add_records(refs)
+    st.session_state.search_info_retrieval.append(len(refs))
+    return refs
 
 
-def refs_per_code(attId, attName):
-    payload = {"attId": attId, "attName": attName}
-    # headers = {
-    #     "Content-Type": "application/json"
-    # }
+def count_textsearch(field="TitleAbstract", query="equity") -> int:
+    """
+    Number of records matching a free-text search, read from the total of a
+    one-record page instead of fetching the records.
+    """
+    return _request_textsearch(get_client(), field, query, page_size=1)[1]
+
+
+def probe_estimator():
+    """
+    Estimator for query_parser.plan_query backed by count-only probes: every
+    term and exact phrase is counted once with count_textsearch.
+    """
+    counts = {}
+
+    def leaf_estimate(node):
+        key = (node.field, node.search_string())
+        if key not in counts:
+            counts[key] = count_textsearch(*key)
+        return counts[key]
+
+    return cardinality_estimator(leaf_estimate)
+
+
+def use_text_index(node) -> bool:
+    """
+    Whether a parsed query can be answered from the local text index: all
+    its fields are indexed, and the index holds every record of the review,
+    or we are offline (cannot ask the server anyway) and the index has been
+    filled from the response cache. Offline, the background sync is waited
+    for (at most OFFLINE_SYNC_TIMEOUT seconds): the count probes of the
+    server path are rarely cached.
+    """
+    index = get_text_index()
+    if not index.covers(node):
+        return False
+    if get_response_cache().offline:
+        return index.synced.wait(OFFLINE_SYNC_TIMEOUT)
+    return len(index) >= get_total_n()
+
+
+def textquery_count(query: str) -> int:
+    """
+    Upper bound of the number of records matching an advanced free-text
+    query, from the local text index if it can answer the query, else from
+    count-only probes of its terms (0 means no match).
+
+    raises:
+        QuerySyntaxError: if the query is malformed
+    """
+    node = parse_query(query)
+    if use_text_index(node):
+        return len(get_text_index().search(node)[0])
+    estimate = probe_estimator()
+    return estimate(plan_query(node, estimate))
 
-    req = st.session_state.session.post(
-        "https://eppi.ioe.ac.uk/eppi-vis/ItemList/GetFreqListJSON",
-        data=payload,
-        cookies={"WebDbErLoginCookie": st.session_state.cookie},
+
+def textquery_ids(query: str, record_store: dict):
+    """
+    Evaluate an advanced free-text query (see query_parser) to itemIds.
+    If the local text index can answer it (see use_text_index), it does so
+    without any request. Otherwise terms and exact phrases are searched on
+    the server, proximity is checked locally and AND operands are evaluated
+    smallest first, as counted by count-only probes; parts that match
+    nothing are not fetched.
+
+    args:
+        query: query string, e.g. title:'AI equity'~5 AND abstract:(machine OR learn*)
+        record_store: itemId -> record, filled with the fetched records
+
+    returns:
+        sorted array of itemIds and the executed plan
+
+    raises:
+        QuerySyntaxError: if the query is malformed
+    """
+    node = parse_query(query)
+    if use_text_index(node):
+        index = get_text_index()
+        ids, plan = index.search(node)
+        for i in ids.tolist():
+            record_store.setdefault(i, index.record(i))
+        return ids, plan
+    estimate = probe_estimator()
+    plan = plan_query(node, estimate)
+    ids = execute_query(plan, textsearch_records, record_store, estimate)
+    return ids, plan
+
+
+def merge_records(record_lists):
+    """
+    OR several record lists: keep the first record of every itemId, in order.
+    Works on the raw record dicts, so no df is built for the duplicates.
+    """
+    seen = set()
+    merged = []
+    for records in record_lists:
+        for record in records:
+            if record["itemId"] not in seen:
+                seen.add(record["itemId"])
+                merged.append(record)
+    return merged
+
+
+def records_for_codes(my_atts: List[Attribute]):
+    """
+    Records coded with any of the given attributes, as a list of record dicts
+    merged on itemId. All pages of every attribute are fetched (see
+    _fetch_all_pages), as conjunction_ids does for its groups, so an arm
+    finds the same records whether or not it is pushed down. The attributes
+    are requested concurrently (at most RECORDS_MAX_WORKERS at a time);
+    per-attribute record counts are appended to
+    st.session_state.search_info_retrieval.
+    """
+    client = get_client()
+    record_lists = _fan_out(
+        lambda a: _fetch_all_pages(client, [a.AttributeId], [a.SetId])[0],
+        [(a,) for a in my_atts],
+        RECORDS_MAX_WORKERS,
     )
-    refs = req.json()["items"]["items"]
-    refdf = pd.DataFrame(refs)
-    st.session_state.search_info_retrieval.append(refdf.shape[0])
-    # print("Retrieved {} records".format(refdf.shape[0]))
+    for records in record_lists:
+        st.session_state.search_info_retrieval.append(len(records))
 
-    return refdf
+    return merge_records(record_lists)
+
+
+def code_count(attribute: Attribute) -> int:
+    """
+    Number of records coded with an attribute. Taken from the cached
+    frequency counts of its parent if we have them, otherwise counted with a
+    one-record page request.
+    """
+    freqs = st.session_state.frequency_counts.get(
+        "{}_{}".format(attribute.ParentAttributeId, attribute.SetId)
+    )
+    if freqs is not None:
+        counts = freqs["Counts"][freqs["attId"] == attribute.AttributeId]
+        if len(counts) > 0:
+            return int(counts.iloc[0])
+    return count_records([attribute.AttributeId], [attribute.SetId])
+
+
+def codes_count(my_atts: List[Attribute]) -> int:
+    """
+    Upper bound of the number of records coded with any of the given
+    attributes: the sum of their counts (0 means no match).
+    """
+    return sum(code_count(a) for a in my_atts)
 
 
 def id_retrieval(my_atts: List[Attribute]):
     """
     This function retrieves references based on a list of attributes,
-    where attributes will be OR'ed, meaning that there is once call to retrieve refs,
-    they are added to the same dataframe, and as last step the frame is deduplicated
-    based on reference ID.
+    where attributes will be OR'ed, and the df is only built for the
+    records merged on itemId (see records_for_codes).
     Args:
         my_atts:
 
     Returns: Pandas DataFrame
 
     """
-    df_list = []
-    for a in my_atts:
-        df_list.append(refs_per_code(a.AttributeId, a.SetId))
-    if len(df_list) > 0:
-        merged = pd.concat(df_list)
-        merged = merged.drop_duplicates(subset=["itemId"], keep="first")
-    else:
-        merged = pd.DataFrame()
-    return merged
+    return pd.DataFrame(records_for_codes(my_atts))
 
 
 @st.cache_data
 def update_display_df(idlist, setlist):
     filtered_atts = []
-    for i, entry in enumerate(idlist):
-        for a in st.session_state.attributes_list:
-            if entry == a.AttributeId and setlist[i] == a.SetId:
-                filtered_atts.append(a)
+    for attId, setId in zip(idlist, setlist):
+        a = st.session_state.attribute_registry.get(attId, setId)
+        if a is not None:
+            filtered_atts.append(a)
 
     my_data = id_retrieval(filtered_atts)
     st.session_state.display_df = my_data
@@ -381,16 +767,13 @@ def get_year_histogram():
     Returns:
 
     """
-    req = st.session_state.session.get(
-        "https://eppi.ioe.ac.uk/eppi-vis/Review/YearHistogramJSON",
-        cookies={"WebDbErLoginCookie": st.session_state.cookie},
-    )
+    req = get_client().request_json("GET", "Review/YearHistogramJSON")
 
     # st.write(req.json())
 
     counts = []
     years = []
-    for entry in req.json():
+    for entry in req:
         years.append(entry["year"])
         counts.append(entry["count"])
 
@@ -403,37 +786,40 @@ def get_year_histogram():
     # print("Retrieved and stored year histogram.")
 
 
-@st.cache_data
-def req_first_page(attribute_ids, set_ids):
+def _request_first_page(
+    client, attribute_ids, set_ids, without_ids=(), without_set_ids=()
+):
     """
-    Get the first page of results for an attribute search.
+    POST the first page of an attribute search to GetListWithWithoutAttsJSON.
+    Returns the records of the page and the total number of records.
     """
-
     payload = {
         "WithAttIds": ",".join(map(str, attribute_ids)),
         "WithSetId": ",".join(map(str, set_ids)),
-        "WithoutAttIds": "",
-        "WithoutSetId": "",
+        "WithoutAttIds": ",".join(map(str, without_ids)),
+        "WithoutSetId": ",".join(map(str, without_set_ids)),
         "included": True,
     }
-    record_json = st.session_state.session.post(
-        "https://eppi.ioe.ac.uk/eppi-vis/ItemList/GetListWithWithoutAttsJSON",
-        data=payload,
-        cookies={"WebDbErLoginCookie": st.session_state.cookie},
+    record_json = client.request_json(
+        "POST", "ItemList/GetListWithWithoutAttsJSON", payload
     )
-    # read as dataframe
-    df = pd.DataFrame(record_json.json()["items"]["items"])
-    total_records = record_json.json()["items"]["totalItemCount"]
-
-    return df, total_records
-
-
-@st.cache_data
-def req_next_page(page_no, description, attribute_ids, set_ids):
+    return record_json["items"]["items"], record_json["items"]["totalItemCount"]
+
+
+def _request_codes_page(
+    client,
+    page_no,
+    page_size,
+    description,
+    attribute_ids,
+    set_ids,
+    without_ids=(),
+    without_set_ids=(),
+):
     """
-    Get subsequent pages of an attribute search.
+    POST a page of an attribute search to ListFromCritJson. Returns the
+    "items" entry of the response: the records and their totalItemCount.
     """
-
     payload = {
         "onlyIncluded": True,
         "showDeleted": False,
@@ -448,7 +834,7 @@ def req_next_page(page_no, description, attribute_ids, set_ids):
         "attributeSetIdList": "",
         "listType": "WebDbWithWithoutCodes",
         "pageNumber": page_no,
-        "pageSize": 100,
+        "pageSize": page_size,
         "totalItems": 0,
         "startPage": 0,
         "endPage": 0,
@@ -465,25 +851,257 @@ def req_next_page(page_no, description, attribute_ids, set_ids):
         "webDbId": 536,
         "withAttributesIds": ",".join(map(str, attribute_ids)),
         "withSetIdsList": ",".join(map(str, set_ids)),
-        "withOutAttributesIdsList": "",
-        "withOutSetIdsList": "",
+        "withOutAttributesIdsList": ",".join(map(str, without_ids)),
+        "withOutSetIdsList": ",".join(map(str, without_set_ids)),
         "searchWhat": "",
         "searchString": "",
     }
 
-    record_json = st.session_state.session.post(
-        "https://eppi.ioe.ac.uk/eppi-vis/ItemList/ListFromCritJson",
-        data=payload,
-        cookies={"WebDbErLoginCookie": st.session_state.cookie},
+    record_json = client.request_json("POST", "ItemList/ListFromCritJson", payload)
+    return record_json["items"]
+
+
+def _request_next_page(
+    client,
+    page_no,
+    description,
+    attribute_ids,
+    set_ids,
+    without_ids=(),
+    without_set_ids=(),
+):
+    """
+    POST a subsequent page of an attribute search to ListFromCritJson.
+    Returns the records of the page.
+    """
+    return _request_codes_page(
+        client,
+        page_no,
+        RECORDS_PAGE_SIZE,
+        description,
+        attribute_ids,
+        set_ids,
+        without_ids,
+        without_set_ids,
+    )["items"]
+
+
+def count_records(attribute_ids, set_ids, without_ids=(), without_set_ids=()) -> int:
+    """
+    Number of records with all of the given attributes (and none of the
+    without ones), read from the total of a one-record page instead of
+    fetching the records.
+    """
+    return _request_codes_page(
+        get_client(), 0, 1, "", attribute_ids, set_ids, without_ids, without_set_ids
+    )["totalItemCount"]
+
+
+def _fetch_all_pages(
+    client, attribute_ids, set_ids, description="", without_ids=(), without_set_ids=()
+):
+    """
+    All records of an attribute search, as a list of record dicts. The first
+    page tells us the total number of records; the remaining pages are then
+    requested concurrently (at most RECORDS_MAX_WORKERS at a time).
+
+    returns:
+        list of records, total number of records
+    """
+    records, total_records = _request_first_page(
+        client, attribute_ids, set_ids, without_ids, without_set_ids
     )
-    # read as dataframe
-    df = pd.DataFrame(record_json.json()["items"]["items"])
+    pages = _fan_out(
+        _request_next_page,
+        [
+            (
+                client,
+                i,
+                description,
+                attribute_ids,
+                set_ids,
+                without_ids,
+                without_set_ids,
+            )
+            for i in range(1, ceil(total_records / RECORDS_PAGE_SIZE))
+        ],
+        RECORDS_MAX_WORKERS,
+    )
+    records = list(records)
+    for page in pages:
+        records.extend(page)
+    get_text_index().add_records(records)
+    return records, total_records
+
+
+def selection_pages(my_atts: List[Attribute], on_page=None):
+    """
+    All records coded with any of the given attributes, a page at a time and
+    without duplicates, for exports that should not hold the whole result in
+    memory: pages are requested one after the other and only the itemIds
+    seen so far are kept.
+
+    args:
+        my_atts: attributes of the selection (OR)
+        on_page: optional callback(records done, upper bound of the records),
+            called after every page, e.g. to update a progress bar
+
+    yields:
+        list of record dicts per page
+    """
+    client = get_client()
+    total = codes_count(my_atts)
+    done = 0
+    seen = set()
+    for attribute in my_atts:
+        page_no = 0
+        n_pages = 1
+        while page_no < n_pages:
+            items = _request_codes_page(
+                client,
+                page_no,
+                RECORDS_PAGE_SIZE,
+                "",
+                [attribute.AttributeId],
+                [attribute.SetId],
+            )
+            n_pages = ceil(items["totalItemCount"] / RECORDS_PAGE_SIZE)
+            page_no += 1
+            done += len(items["items"])
+            page = [r for r in items["items"] if r["itemId"] not in seen]
+            seen.update(r["itemId"] for r in page)
+            if on_page is not None:
+                on_page(done, max(total, done))
+            yield page
+
+
+@st.cache_data
+def fetch_all_records(
+    attribute_ids, set_ids, description="", without_ids=(), without_set_ids=()
+):
+    """
+    Get all records of an attribute search, building the df once from all
+    collected pages (see _fetch_all_pages).
+
+    args:
+        attribute_ids: ids of the attributes records must have (AND)
+        set_ids: set ids of these attributes
+        description: search description sent with subsequent page requests
+        without_ids: ids of attributes records must not have
+        without_set_ids: set ids of these attributes
+
+    returns:
+        df of all records, total number of records
+    """
+    records, total_records = _fetch_all_pages(
+        get_client(),
+        attribute_ids,
+        set_ids,
+        description,
+        without_ids,
+        without_set_ids,
+    )
+    return pd.DataFrame(records), total_records
+
+
+def conjunction_ids(
+    with_groups: List[List[Attribute]],
+    without_atts: List[Attribute],
+    record_store: dict,
+    max_requests: int = PUSHDOWN_MAX_REQUESTS,
+):
+    """
+    ItemIds of the records coded with at least one attribute of every group
+    in with_groups and with none of without_atts, answered by the server as
+    far as it can: GetListWithWithoutAttsJSON ANDs its with-attributes and
+    excludes its without-attributes, but cannot OR. Groups with several
+    attributes are therefore distributed over one request per combination
+    (smallest groups first, while at most max_requests requests result) and
+    the results united; groups beyond that are fetched per code (all pages)
+    and intersected locally. If no group fits, no combined request is sent
+    and the without-attributes are excluded locally as well.
+
+    args:
+        with_groups: attribute groups to AND, the attributes of a group are OR'd
+        without_atts: attributes records must not have
+        record_store: itemId -> record, filled with the fetched records
+        max_requests: bound for the number of combined requests
+
+    returns:
+        sorted array of itemIds, number of server-side searches
+    """
+    groups = sorted(with_groups, key=codes_count)
+    pushed = [g for g in groups if len(g) == 1]
+    local = []
+    n_requests = 1
+    for group in groups:
+        if len(group) == 1:
+            continue
+        if n_requests * len(group) <= max_requests:
+            pushed.append(group)
+            n_requests *= len(group)
+        else:
+            local.append(group)
+
+    client = get_client()
+
+    def group_ids(group):
+        # all pages of every code of the group, OR'd
+        return or_ids(
+            *[
+                index_records(
+                    _fetch_all_pages(client, [a.AttributeId], [a.SetId])[0],
+                    record_store,
+                )
+                for a in group
+            ]
+        )
+
+    if len(groups) == 0:
+        return EMPTY_IDS, 0
+    if len(pushed) == 0:
+        # no group fits into a request: nothing for the server to AND, start
+        # from the smallest group and exclude the without-attributes here
+        ids = group_ids(local[0])
+        for group in local[1:]:
+            if len(ids) == 0:
+                break
+            ids = and_ids(ids, group_ids(group))
+        if len(ids) > 0 and len(without_atts) > 0:
+            ids = not_ids(ids, group_ids(without_atts))
+        return ids, 0
+
+    without_ids = tuple(a.AttributeId for a in without_atts)
+    without_set_ids = tuple(a.SetId for a in without_atts)
+    requests = []
+    for combination in product(*pushed):
+        # the same code may have been picked in several arms
+        unique = list({a.AttributeId: a for a in combination}.values())
+        requests.append(
+            (
+                tuple(a.AttributeId for a in unique),
+                tuple(a.SetId for a in unique),
+                "",
+                without_ids,
+                without_set_ids,
+            )
+        )
+
+    results = _fan_out(
+        lambda *args: _fetch_all_pages(client, *args)[0],
+        requests,
+        RECORDS_MAX_WORKERS,
+    )
+    ids = or_ids(*[index_records(records, record_store) for records in results])
+    for group in local:
+        if len(ids) == 0:
+            break
+        ids = and_ids(ids, group_ids(group))
+    return ids, len(requests)
 
-    return df
 
 def get_total_n():
-    r1 = st.session_state.session.get('https://eppi.ioe.ac.uk/eppi-vis/ItemList/IndexJSON', cookies={'WebDbErLoginCookie': st.session_state.cookie})
-    res = r1.json()
+    res = get_client().request_json("GET", "ItemList/IndexJSON")
 
     total_n = res["items"]["totalItemCount"]
     return total_n
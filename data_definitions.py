@@ -5,19 +5,178 @@
 from enum import Enum
 from typing import Annotated
 
+import numpy as np
+
+
 class Attribute():
-    AttributeId: int = 0
+    # slots instead of a per-instance __dict__: we hold one instance per code
+    # per session, so the dict overhead adds up
+    __slots__ = (
+        "AttributeId",
+        "AttributeName",
+        "AttributeSetDescription",
+        "ParentAttributeId",
+        "SetId",
+        "HasChildren",
+    )
+
+    AttributeId: int
     AttributeName: str
-    AttributeSetDescription: str = ''
+    AttributeSetDescription: str
     #AttributeType: AttrType = AttrType.NOT_SELECTABLE
-    ParentAttributeId: int = 0
-    SetId: int = 0
+    ParentAttributeId: int
+    SetId: int
 
     #AttributeSetId: int = 0
-    AttributeSetDescription: str = ''
-    HasChildren: bool = False
+    HasChildren: bool
 
     #ExtURL: str = ''
     #ExtType: str = ''
     #OriginalAttributeID: int = 0
-    #Attributes: AttrList | None = None
\ No newline at end of file
+    #Attributes: AttrList | None = None
+
+    def __init__(
+        self,
+        AttributeId: int = 0,
+        AttributeName: str = '',
+        AttributeSetDescription: str = '',
+        ParentAttributeId: int = 0,
+        SetId: int = 0,
+        HasChildren: bool = False,
+    ):
+        self.AttributeId = AttributeId
+        self.AttributeName = AttributeName
+        self.AttributeSetDescription = AttributeSetDescription
+        self.ParentAttributeId = ParentAttributeId
+        self.SetId = SetId
+        self.HasChildren = HasChildren
+
+
+class AttributeRegistry():
+    """
+    Index over the attributes of all codesets. Built once from the parsed
+    FetchJSON codeset so that lookups don't need to scan the attributes list.
+
+    Besides the dict indexes, the registry keeps the numeric attribute fields
+    as columns (NumPy arrays aligned with self.attributes), so bulk filters
+    such as "all parents" or "all leaves of set X" are vectorized. The
+    Attribute objects themselves serve as row views.
+    """
+
+    def __init__(self, attributes):
+        self.attributes = list(attributes)
+        self._by_id = {}
+        self._by_id_set = {}
+        self._by_name_parent = {}
+        self._children = {}
+
+        for a in self.attributes:
+            self._by_id.setdefault(a.AttributeId, a)
+            self._by_id_set[(a.AttributeId, a.SetId)] = a
+            self._by_name_parent.setdefault((a.AttributeName, a.ParentAttributeId), a)
+            self._children.setdefault(a.ParentAttributeId, []).append(a)
+
+        n = len(self.attributes)
+        self.attribute_ids = np.fromiter(
+            (a.AttributeId or 0 for a in self.attributes), dtype=np.int64, count=n
+        )
+        self.parent_ids = np.fromiter(
+            (a.ParentAttributeId or 0 for a in self.attributes), dtype=np.int64, count=n
+        )
+        self.set_ids = np.fromiter(
+            (a.SetId or 0 for a in self.attributes), dtype=np.int64, count=n
+        )
+        self.has_children = np.fromiter(
+            (bool(a.HasChildren) for a in self.attributes), dtype=bool, count=n
+        )
+
+        # hierarchy as row indices: the parent row of every attribute (-1 at
+        # the top level) and the rows ordered bottom-up, deepest level first
+        row_of = {(a.AttributeId, a.SetId): i for i, a in enumerate(self.attributes)}
+        self.parent_rows = np.fromiter(
+            (row_of.get((a.ParentAttributeId, a.SetId), -1) for a in self.attributes),
+            dtype=np.int64,
+            count=n,
+        )
+        self.depths = np.zeros(n, dtype=np.int64)
+        ancestors = self.parent_rows.copy()
+        for _ in range(n):
+            above = ancestors >= 0
+            if not above.any():
+                break
+            self.depths[above] += 1
+            ancestors[above] = self.parent_rows[ancestors[above]]
+        self.bottom_up = np.argsort(-self.depths, kind="stable")
+        # bottom_up[level_bounds[k]:level_bounds[k + 1]] is one level
+        self.level_bounds = np.flatnonzero(
+            np.diff(self.depths[self.bottom_up], prepend=-1, append=-1)
+        )
+
+    def __len__(self):
+        return len(self.attributes)
+
+    def __iter__(self):
+        return iter(self.attributes)
+
+    def get(self, attribute_id, set_id=None):
+        """
+        Attribute by id, or by (id, set id) if set_id is given. None if unknown.
+        """
+        if set_id is None:
+            return self._by_id.get(attribute_id)
+        return self._by_id_set.get((attribute_id, set_id))
+
+    def find(self, name, parent_id):
+        """
+        Attribute by display name below the given parent. None if unknown.
+        """
+        return self._by_name_parent.get((name, parent_id))
+
+    def children(self, parent_id):
+        """
+        Direct children of the given parent attribute, in codeset order.
+        """
+        return self._children.get(parent_id, [])
+
+    def rows(self, mask):
+        """
+        Attributes selected by a boolean mask over the columns, in codeset order.
+        """
+        return [self.attributes[i] for i in np.flatnonzero(mask)]
+
+    def set_mask(self, set_id=None):
+        """
+        Boolean mask of the attributes in the given set (all if set_id is None).
+        """
+        if set_id is None:
+            return np.ones(len(self.attributes), dtype=bool)
+        return self.set_ids == set_id
+
+    def parents(self, set_id=None):
+        """
+        All attributes that have children, optionally only of one set.
+        """
+        return self.rows(self.has_children & self.set_mask(set_id))
+
+    def rollup(self, values) -> np.ndarray:
+        """
+        Branch totals of per-attribute values (aligned with self.attributes),
+        as plotly's branchvalues="total" needs them: attributes without
+        children keep their value, all others get the sum of their children's
+        totals. One vectorized step per level, from the deepest level up.
+        """
+        totals = np.array(values, dtype=np.int64)
+        has_rows_below = np.zeros(len(totals), dtype=bool)
+        has_rows_below[self.parent_rows[self.parent_rows >= 0]] = True
+        totals[has_rows_below] = 0
+        for lo, hi in zip(self.level_bounds[:-1], self.level_bounds[1:]):
+            rows = self.bottom_up[lo:hi]
+            rows = rows[self.parent_rows[rows] >= 0]
+            np.add.at(totals, self.parent_rows[rows], totals[rows])
+        return totals
+
+    def leaves(self, set_id=None):
+        """
+        All attributes without children, optionally only of one set.
+        """
+        return self.rows(~self.has_children & self.set_mask(set_id))
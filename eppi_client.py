@@ -0,0 +1,209 @@
+"""
+HTTP client for the EPPI-Vis API.
+
+One EppiVisClient owns a pooled requests session with keep-alive, default
+timeouts, retries with exponential backoff and the login cookie. It is safe to
+share between the worker threads of a fan-out: the connection pool is
+thread-safe, the cookie is passed explicitly with every request and logins are
+serialised by a lock.
+"""
+
+import json
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from response_cache import OfflineCacheMiss, get_response_cache
+from tenacity import (
+    Retrying,
+    retry_if_exception_type,
+    stop_after_attempt,
+    wait_exponential,
+)
+
+EPPI_BASE_URL = "https://eppi.ioe.ac.uk"
+EPPI_VIS_API = EPPI_BASE_URL + "/eppi-vis/"
+LOGIN_COOKIE = "WebDbErLoginCookie"
+
+# seconds a response in the persistent response cache stays fresh
+RESPONSE_CACHE_TTL = 60 * 60
+# seconds after which we log in again even if the cookie has no expiry
+COOKIE_MAX_AGE = 6 * 60 * 60
+
+# statuses worth another attempt: rate limiting and transient gateway errors
+RETRY_STATUSES = (429, 502, 503, 504)
+RETRY_ERRORS = (requests.ConnectionError, requests.Timeout, requests.HTTPError)
+
+
+class EppiVisClient():
+    """
+    Pooled, thread-safe client for one EPPI-Vis WebDB.
+
+    args:
+        webdb_id: id of the WebDB to log in to
+        pool_size: maximum number of kept-alive connections, should be at
+            least the largest fan-out of concurrent requests
+        timeout: default (connect, read) timeout in seconds
+        retries: maximum number of attempts per request
+        backoff: base of the exponential backoff between attempts, in seconds
+    """
+
+    def __init__(
+        self,
+        webdb_id: int = 536,
+        pool_size: int = 16,
+        timeout=(5, 60),
+        retries: int = 3,
+        backoff: float = 0.5,
+    ):
+        self.webdb_id = webdb_id
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=2, pool_maxsize=pool_size, pool_block=True
+        )
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+        self.cookie = None
+        self.cookie_expires = None
+        self.logged_in_at = None
+        self._login_lock = threading.Lock()
+
+    def login(self):
+        """
+        Open the WebDB and store the login cookie.
+        """
+        with self._login_lock:
+            self._login()
+
+    def _login(self):
+        if get_response_cache().offline:
+            # replaying cached responses, there is nobody to log in to
+            self.cookie = ""
+            self.logged_in_at = time.time()
+            return
+        req = self.session.get(
+            "{}/EPPI-Vis/Login/Open?WebDBid={}".format(EPPI_BASE_URL, self.webdb_id),
+            timeout=self.timeout,
+        )
+        req.raise_for_status()
+        self.cookie = self.session.cookies[LOGIN_COOKIE]
+        # session cookies have no expiry
+        expires = [c.expires for c in self.session.cookies if c.name == LOGIN_COOKIE]
+        self.cookie_expires = expires[0] if expires and expires[0] else None
+        self.logged_in_at = time.time()
+
+    def cookie_expired(self) -> bool:
+        now = time.time()
+        return (
+            self.cookie is None
+            or now - self.logged_in_at >= COOKIE_MAX_AGE
+            or (self.cookie_expires is not None and now >= self.cookie_expires)
+        )
+
+    def ensure_login(self):
+        """
+        Log in if there is no cookie yet or it has expired.
+        """
+        if self.cookie_expired():
+            with self._login_lock:
+                if self.cookie_expired():
+                    self._login()
+
+    def _relogin(self, stale_cookie):
+        # several workers may notice the same stale cookie, only log in once
+        with self._login_lock:
+            if self.cookie == stale_cookie:
+                self._login()
+
+    def request(
+        self, method: str, endpoint: str, payload=None, headers=None, timeout=None
+    ):
+        """
+        Send a request to an EPPI-Vis API endpoint (relative to EPPI_VIS_API),
+        retrying connection errors, timeouts and RETRY_STATUSES with backoff.
+        A response that bounced to the login page means the cookie expired: we
+        log in again and repeat the request once.
+
+        returns:
+            requests.Response
+        """
+        self.ensure_login()
+        for attempt in Retrying(
+            stop=stop_after_attempt(self.retries),
+            wait=wait_exponential(multiplier=self.backoff, max=10),
+            retry=retry_if_exception_type(RETRY_ERRORS),
+            reraise=True,
+        ):
+            with attempt:
+                cookie = self.cookie
+                req = self._send(method, endpoint, payload, headers, timeout, cookie)
+                if req.status_code in (401, 403) or "/Login" in req.url:
+                    self._relogin(cookie)
+                    req = self._send(
+                        method, endpoint, payload, headers, timeout, self.cookie
+                    )
+                if req.status_code in RETRY_STATUSES:
+                    req.raise_for_status()
+        return req
+
+    def _send(self, method, endpoint, payload, headers, timeout, cookie):
+        return self.session.request(
+            method,
+            EPPI_VIS_API + endpoint,
+            data=payload,
+            headers=headers,
+            cookies={LOGIN_COOKIE: cookie},
+            timeout=timeout if timeout is not None else self.timeout,
+        )
+
+    def request_json(
+        self,
+        method: str,
+        endpoint: str,
+        payload=None,
+        ttl: float = RESPONSE_CACHE_TTL,
+        timeout=None,
+    ):
+        """
+        Like request, but returns the decoded json and goes through the
+        persistent response cache: fresh cached responses are served without
+        network I/O, successful ones are stored.
+
+        raises:
+            OfflineCacheMiss: in offline mode, if the response is not cached
+        """
+        cache = get_response_cache()
+        key = cache.key(method, endpoint, payload)
+        text = cache.get(key, ttl)
+        if text is None:
+            if cache.offline:
+                raise OfflineCacheMiss("{} {} {}".format(method, endpoint, payload))
+            req = self.request(method, endpoint, payload, timeout=timeout)
+            text = req.text
+            if req.ok:
+                cache.put(key, endpoint, text)
+        return json.loads(text)
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_webdb_client(webdb_id: int = 536) -> EppiVisClient:
+    """
+    The process-wide client of a WebDB, shared by all sessions and reruns.
+    Logs in on first use and again once the cookie has expired; otherwise
+    no network I/O happens here.
+    """
+    with _clients_lock:
+        client = _clients.get(webdb_id)
+        if client is None:
+            client = _clients[webdb_id] = EppiVisClient(webdb_id=webdb_id)
+    client.ensure_login()
+    return client
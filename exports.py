@@ -0,0 +1,277 @@
+"""
+Streaming exports of records to RIS, CSV, Parquet and XLSX.
+
+Records arrive as chunks: slices of a df a page already holds (frame_chunks),
+or pages pulled from the API one at a time (api_calls.selection_pages). Every
+writer formats and writes one chunk before asking for the next, so memory is
+bounded by the chunk size, not by the size of the result:
+    RIS: fields formatted column-wise per chunk, yielded as bytes
+    CSV: to_csv per chunk, the header with the first one
+    Parquet: one row group per chunk (pyarrow ParquetWriter)
+    XLSX: rows appended to an openpyxl write-only sheet
+"""
+
+import io
+import os
+import tempfile
+import weakref
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from openpyxl import Workbook
+from openpyxl.cell.cell import ILLEGAL_CHARACTERS_RE
+
+# rows per chunk when exporting an in-memory df
+EXPORT_CHUNK_ROWS = 1000
+
+# RIS tag -> record column, in the order they are written (A1 and PY are
+# formatted separately, see ris_chunks)
+RIS_FIELDS = [
+    ("T1", "title"),
+    ("N2", "abstract"),
+    ("A1", "authors"),
+    ("IS", "issue"),
+    ("VL", "volume"),
+    ("JO", "parentTitle"),
+    ("SP", "pages"),
+    ("PY", "year"),
+    ("SN", "standardNumber"),
+    ("DO", "doi"),
+    ("CY", "city"),
+    ("PB", "publisher"),
+    ("UR", "url"),
+]
+
+
+def frame_chunks(chunks, chunk_rows: int = EXPORT_CHUNK_ROWS):
+    """
+    Normalise an export source to a stream of dfs.
+
+    args:
+        chunks: a df (sliced into chunk_rows rows), or an iterable of dfs
+            and/or lists of record dicts (e.g. API pages)
+        chunk_rows: rows per slice of a df
+
+    yields:
+        non-empty dfs; an empty df is yielded as it is, so its columns are
+        still written
+    """
+    if isinstance(chunks, pd.DataFrame):
+        for start in range(0, max(chunks.shape[0], 1), chunk_rows):
+            yield chunks.iloc[start : start + chunk_rows]
+        return
+    for chunk in chunks:
+        if not isinstance(chunk, pd.DataFrame):
+            chunk = pd.DataFrame(chunk)
+        if chunk.shape[0] > 0:
+            yield chunk
+
+
+def _text_column(chunk: pd.DataFrame, column: str) -> pd.Series:
+    # a column as stripped strings, "" where missing
+    if column not in chunk:
+        return pd.Series("", index=chunk.index, dtype=object)
+    return chunk[column].fillna("").astype(str).str.strip()
+
+
+def _ris_lines(tag: str, values: pd.Series) -> pd.Series:
+    # one "TAG  - value" line per non-empty value, "" otherwise
+    return (tag + "  - " + values + "\n").where(values != "", "")
+
+
+def _ris_years(chunk: pd.DataFrame) -> pd.Series:
+    # whole years, so a year read as float (2022.0) is written as 2022
+    years = _text_column(chunk, "year")
+    numeric = pd.to_numeric(years, errors="coerce")
+    whole = numeric.fillna(0).astype("int64").astype(str)
+    return whole.where(numeric.notna(), years)
+
+
+def _ris_authors(chunk: pd.DataFrame) -> pd.Series:
+    # authors are ";"-separated, one A1 line each
+    authors = (
+        _text_column(chunk, "authors")
+        .str.replace(r"\s*(;\s*)+", ";", regex=True)
+        .str.strip(";")
+    )
+    return _ris_lines("A1", authors.str.replace(";", "\nA1  - ", regex=False))
+
+
+def ris_chunks(chunks):
+    """
+    RIS export of records, formatted a chunk at a time: every field is built
+    for the whole chunk with vectorized string operations and the chunk's
+    records are joined into one bytes object.
+
+    args:
+        chunks: export source, see frame_chunks
+
+    yields:
+        utf-8 encoded RIS text of each chunk
+    """
+    for chunk in frame_chunks(chunks):
+        if chunk.shape[0] == 0:
+            # RIS has no header to write
+            continue
+        text = pd.Series("TY  - JOUR\n", index=chunk.index, dtype=object)
+        for tag, column in RIS_FIELDS:
+            if tag == "A1":
+                text += _ris_authors(chunk)
+            elif tag == "PY":
+                text += _ris_lines(tag, _ris_years(chunk))
+            else:
+                text += _ris_lines(tag, _text_column(chunk, column))
+        notes = (
+            chunk["quickCitation"].fillna("").astype(str)
+            if "quickCitation" in chunk
+            else ""
+        )
+        text += "N1  - " + notes + "\nER  - \n\n"
+        yield "".join(text.tolist()).encode("utf-8")
+
+
+def write_ris(chunks, fileobj):
+    """
+    Write the RIS export of records to a binary file object.
+    """
+    for data in ris_chunks(chunks):
+        fileobj.write(data)
+
+
+def write_csv(chunks, fileobj, encoding: str = "utf-8-sig"):
+    """
+    Write records as csv to a binary file object. The columns are those of
+    the first chunk.
+    """
+    # the wrapper writes a BOM (utf-8-sig) once, at the start of the file
+    text = io.TextIOWrapper(fileobj, encoding=encoding, newline="")
+    columns = None
+    for chunk in frame_chunks(chunks):
+        header = columns is None
+        if header:
+            columns = list(chunk.columns)
+        chunk.reindex(columns=columns).to_csv(text, header=header, index=False)
+    text.flush()
+    text.detach()
+
+
+def write_parquet(chunks, fileobj):
+    """
+    Write records to a binary file object as parquet, one row group per
+    chunk. All columns are stored as strings, so the schema taken from the
+    first chunk fits every page. Without any chunk (no records) the file
+    holds an empty table without columns, so it is still valid parquet.
+    """
+    writer = None
+    for chunk in frame_chunks(chunks):
+        if writer is None:
+            columns = list(chunk.columns)
+            schema = pa.schema([(c, pa.string()) for c in columns])
+            writer = pq.ParquetWriter(fileobj, schema)
+        table = pa.Table.from_pandas(
+            chunk.reindex(columns=columns).astype("string"),
+            schema=schema,
+            preserve_index=False,
+        )
+        writer.write_table(table)
+    if writer is None:
+        writer = pq.ParquetWriter(fileobj, pa.schema([]))
+    writer.close()
+
+
+def write_xlsx(chunks, fileobj):
+    """
+    Write records to a binary file object as xlsx. The workbook is
+    write-only, so openpyxl streams the rows instead of keeping a cell
+    object per value.
+    """
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet("records")
+    columns = None
+    for chunk in frame_chunks(chunks):
+        if columns is None:
+            columns = list(chunk.columns)
+            sheet.append(columns)
+        values = (
+            chunk.reindex(columns=columns)
+            .astype("string")
+            .replace(ILLEGAL_CHARACTERS_RE, "", regex=True)
+            .astype(object)
+        )
+        for row in values.where(values.notna(), None).itertuples(
+            index=False, name=None
+        ):
+            sheet.append(row)
+    workbook.save(fileobj)
+
+
+# format -> writer, file extension, mime type
+EXPORT_FORMATS = {
+    "RIS": (write_ris, "ris", "application/x-research-info-systems"),
+    "CSV": (write_csv, "csv", "text/csv"),
+    "Parquet": (
+        write_parquet,
+        "parquet",
+        "application/vnd.apache.parquet",
+    ),
+    "XLSX": (
+        write_xlsx,
+        "xlsx",
+        "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    ),
+}
+
+
+def export_bytes(chunks, export_format: str) -> bytes:
+    """
+    Export records in one of EXPORT_FORMATS and return the file contents.
+    """
+    buffer = io.BytesIO()
+    EXPORT_FORMATS[export_format][0](chunks, buffer)
+    return buffer.getvalue()
+
+
+def _remove_file(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+class ExportFile():
+    """
+    A temporary export file. It is removed by remove(), or else once the
+    object is garbage collected (e.g. with the session state holding it when
+    the session ends) or at interpreter exit.
+
+    args:
+        path: path of the file
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._finalizer = weakref.finalize(self, _remove_file, path)
+
+    def exists(self) -> bool:
+        return self._finalizer.alive and os.path.exists(self.path)
+
+    def remove(self):
+        self._finalizer()
+
+
+def export_file(chunks, export_format: str) -> ExportFile:
+    """
+    Export records in one of EXPORT_FORMATS to a temporary file, a chunk at a
+    time.
+
+    returns:
+        ExportFile of the file
+    """
+    writer, extension, _ = EXPORT_FORMATS[export_format]
+    with tempfile.NamedTemporaryFile(
+        suffix="." + extension, prefix="eppi_vis_export_", delete=False
+    ) as fileobj:
+        export = ExportFile(fileobj.name)
+        writer(chunks, fileobj)
+    return export
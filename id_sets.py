@@ -0,0 +1,167 @@
+"""
+Set algebra over item ids, used to combine the arms of a boolean search.
+
+Every arm's result is a sorted array of unique itemIds (NumPy int64), so
+AND/OR/NOT over any number of arms are vectorized set operations. Record
+metadata is kept once per itemId in a record store and only turned into a
+DataFrame for the final set.
+
+A ResultHandle identifies a result df (its ids in row order, the columns
+shown and the values of its rows) by a fingerprint, a cache key for anything
+derived from the records.
+"""
+
+import hashlib
+from functools import reduce
+
+import numpy as np
+import pandas as pd
+
+EMPTY_IDS = np.empty(0, dtype=np.int64)
+
+
+def to_id_array(ids) -> np.ndarray:
+    """
+    Sorted array of the unique item ids in ids.
+    """
+    return np.unique(np.fromiter(ids, dtype=np.int64))
+
+
+def index_records(records, record_store: dict) -> np.ndarray:
+    """
+    Add records (dicts with an "itemId") to the record store, keeping the
+    first record seen per itemId, and return their id array.
+    """
+    for record in records:
+        record_store.setdefault(record["itemId"], record)
+    return to_id_array(record["itemId"] for record in records)
+
+
+def and_ids(*id_arrays) -> np.ndarray:
+    """
+    Intersection of all id arrays, smallest first so intermediates stay small.
+    """
+    if len(id_arrays) == 0:
+        return EMPTY_IDS
+    ordered = sorted(id_arrays, key=len)
+    return reduce(
+        lambda left, right: np.intersect1d(left, right, assume_unique=True),
+        ordered[1:],
+        ordered[0],
+    )
+
+
+def or_ids(*id_arrays) -> np.ndarray:
+    """
+    Union of all id arrays.
+    """
+    if len(id_arrays) == 0:
+        return EMPTY_IDS
+    return np.unique(np.concatenate(id_arrays))
+
+
+def not_ids(base: np.ndarray, *id_arrays) -> np.ndarray:
+    """
+    Ids of base that are in none of the other id arrays.
+    """
+    if len(id_arrays) == 0:
+        return base
+    return np.setdiff1d(base, or_ids(*id_arrays), assume_unique=True)
+
+
+def apply_operator(result: np.ndarray, id_arrays, operator: str) -> np.ndarray:
+    """
+    Combine the running result with one or more arms joined by the same
+    operator ("AND", "OR" or "NOT", meaning AND NOT).
+    """
+    if operator == "AND":
+        return and_ids(result, *id_arrays)
+    if operator == "NOT":
+        return not_ids(result, *id_arrays)
+    return or_ids(result, *id_arrays)
+
+
+def arms_to_fetch(arm_counts, operators):
+    """
+    Which arms of a left-to-right search (operators[i] joins arm i to
+    everything before it, see apply_operator) need their records, given an
+    upper bound of each arm's size (None if unknown, 0 must mean empty).
+    Empty arms are never fetched, and neither is anything before an empty
+    arm joined by AND, since that part of the search ends up empty whatever
+    it contains.
+
+    returns:
+        list of bools, one per arm
+    """
+    fetch = [count is None or count > 0 for count in arm_counts]
+    for j in range(len(arm_counts) - 1, -1, -1):
+        if arm_counts[j] == 0 and (j == 0 or operators[j] == "AND"):
+            fetch[:j] = [False] * j
+            break
+    return fetch
+
+
+def records_frame(ids: np.ndarray, record_store: dict, columns=None) -> pd.DataFrame:
+    """
+    DataFrame of the stored records of the given ids, in id order. With
+    columns, exactly these columns (missing keys are NaN), so records from
+    different sources give the same frame.
+    """
+    return pd.DataFrame([record_store[i] for i in ids.tolist()], columns=columns)
+
+
+class ResultHandle():
+    """
+    Immutable handle of a result: its itemIds in row order and the column
+    projection, with a fingerprint (digest) over both and, optionally, over
+    the content of the rows. Caches keyed on the fingerprint never pickle
+    the cells of a df, and identical results reached from different pages
+    share cache entries.
+
+    args:
+        ids: itemIds of the result, in row order
+        columns: names of the projected columns, in order
+        content: optional digest bytes of the row values
+    """
+
+    __slots__ = ("ids", "columns", "fingerprint")
+
+    def __init__(self, ids, columns=(), content=b""):
+        ids = np.array(ids, dtype=np.int64)
+        ids.flags.writeable = False
+        columns = tuple(str(c) for c in columns)
+        digest = hashlib.blake2b(ids.tobytes(), digest_size=16)
+        digest.update("\x1f".join(columns).encode("utf-8"))
+        digest.update(content)
+        object.__setattr__(self, "ids", ids)
+        object.__setattr__(self, "columns", columns)
+        object.__setattr__(self, "fingerprint", digest.hexdigest())
+
+    @classmethod
+    def of_frame(cls, df: pd.DataFrame):
+        """
+        Handle of a df of records: its "itemId" column, its columns and the
+        values of its rows, so changed records give a new fingerprint.
+        """
+        ids = df["itemId"].to_numpy() if "itemId" in df else EMPTY_IDS
+        try:
+            rows = pd.util.hash_pandas_object(df, index=False)
+        except TypeError:
+            # cells holding lists or dicts are hashed as their text
+            rows = pd.util.hash_pandas_object(df.astype(str), index=False)
+        return cls(ids, df.columns, rows.to_numpy().tobytes())
+
+    def __setattr__(self, name, value):
+        raise AttributeError("ResultHandle is immutable")
+
+    def __repr__(self):
+        return "ResultHandle({} ids, {} columns, {})".format(
+            len(self.ids), len(self.columns), self.fingerprint[:12]
+        )
+
+
+def frame_fingerprint(df: pd.DataFrame) -> str:
+    """
+    Fingerprint of a df of records, for st.cache_data(hash_funcs=...).
+    """
+    return ResultHandle.of_frame(df).fingerprint
@@ -0,0 +1,185 @@
+"""
+Sparse item x code incidence matrix, the local analytics engine behind
+frequencies, crosstabs and drill-downs.
+
+The matrix is stored column-wise (CSC layout, as scipy.sparse would): column
+j holds the row indices of the items coded with attribute j, in
+indices[indptr[j]:indptr[j + 1]], and row i stands for item_ids[i]. With it
+    frequency of a code = column sum = length of its column
+    crosstab of two code lists = X^T . Y, counted over their columns
+    drill-down to a cell = intersection of the columns' rows
+are answered in-process, without a request per interaction.
+
+YearCube adds the publication year of every item: an attributes x years
+count cube with cumulative sums along the years, so the counts of any year
+range are one subtraction per attribute.
+"""
+
+import numpy as np
+from id_sets import EMPTY_IDS, and_ids, or_ids, to_id_array
+
+
+class IncidenceMatrix():
+    """
+    Items x attributes incidence matrix in CSC layout.
+
+    args:
+        attribute_ids: attribute id of every column
+        item_lists: per column, the ids of the items coded with it
+        years: optional itemId -> publication year (see parse_year), kept
+            per row in item_years (0 if unknown)
+    """
+
+    def __init__(self, attribute_ids, item_lists, years=None):
+        columns = [to_id_array(ids) for ids in item_lists]
+        self.attribute_ids = np.asarray(attribute_ids, dtype=np.int64)
+        self._column = {a: j for j, a in enumerate(self.attribute_ids.tolist())}
+        self.item_ids = or_ids(*columns)
+        self.indptr = np.zeros(len(columns) + 1, dtype=np.int64)
+        np.cumsum([len(c) for c in columns], out=self.indptr[1:])
+        self.indices = (
+            np.searchsorted(self.item_ids, np.concatenate(columns)).astype(np.int32)
+            if len(columns) > 0
+            else np.empty(0, dtype=np.int32)
+        )
+        years = years or {}
+        self.item_years = np.asarray(
+            [years.get(i, 0) for i in self.item_ids.tolist()], dtype=np.int64
+        )
+
+    @property
+    def shape(self):
+        return len(self.item_ids), len(self.attribute_ids)
+
+    def rows(self, attribute_id) -> np.ndarray:
+        """
+        Row indices of the items coded with an attribute.
+        """
+        j = self._column.get(attribute_id)
+        if j is None:
+            return self.indices[:0]
+        return self.indices[self.indptr[j] : self.indptr[j + 1]]
+
+    def items(self, attribute_id) -> np.ndarray:
+        """
+        Sorted ids of the items coded with an attribute.
+        """
+        return self.item_ids[self.rows(attribute_id)]
+
+    def frequencies(self, attribute_ids) -> np.ndarray:
+        """
+        Number of items coded with each attribute: the column sums.
+        """
+        counts = np.diff(self.indptr)
+        return np.asarray(
+            [
+                counts[self._column[a]] if a in self._column else 0
+                for a in attribute_ids
+            ],
+            dtype=np.int64,
+        )
+
+    def crosstab(self, x_attribute_ids, y_attribute_ids) -> np.ndarray:
+        """
+        Number of items coded with both x_attribute_ids[i] and
+        y_attribute_ids[j], as a (len(x) x len(y)) matrix (X^T . Y),
+        computed on the stored columns: per x column, its rows are marked
+        and the marked entries of all y columns are counted at once.
+        """
+        counts = np.zeros((len(x_attribute_ids), len(y_attribute_ids)), np.int64)
+        y_rows = [self.rows(a) for a in y_attribute_ids]
+        lengths = [len(rows) for rows in y_rows]
+        if len(x_attribute_ids) == 0 or sum(lengths) == 0:
+            return counts
+        y_entries = np.concatenate(y_rows)
+        y_columns = np.repeat(np.arange(len(y_attribute_ids)), lengths)
+        marked = np.zeros(len(self.item_ids), dtype=bool)
+        for i, attribute_id in enumerate(x_attribute_ids):
+            rows = self.rows(attribute_id)
+            marked[rows] = True
+            counts[i] = np.bincount(
+                y_columns[marked[y_entries]], minlength=len(y_attribute_ids)
+            )
+            marked[rows] = False
+        return counts
+
+    def drilldown(self, attribute_ids) -> np.ndarray:
+        """
+        Sorted ids of the items coded with all of the given attributes.
+        """
+        if len(attribute_ids) == 0:
+            return EMPTY_IDS
+        return and_ids(*[self.items(a) for a in attribute_ids])
+
+
+def parse_year(value) -> int:
+    """
+    Publication year of a record's "year" value, 0 if unknown.
+    """
+    try:
+        year = int(float(str(value).strip()))
+    except ValueError:
+        return 0
+    return year if year > 0 else 0
+
+
+class YearCube():
+    """
+    Attributes x years counts of an incidence matrix, with cumulative sums
+    along the year axis: cumulative[j, k] is the number of items coded with
+    column j and published before first_year + k. Items without a year are
+    not counted.
+
+    args:
+        matrix: IncidenceMatrix
+        item_years: publication year of every row of matrix (0 if unknown)
+    """
+
+    def __init__(self, matrix: IncidenceMatrix, item_years):
+        item_years = np.asarray(item_years, dtype=np.int64)
+        known = item_years > 0
+        self.attribute_ids = matrix.attribute_ids
+        self._column = {a: j for j, a in enumerate(self.attribute_ids.tolist())}
+        n_columns = len(self.attribute_ids)
+        if not known.any():
+            self.first_year = self.last_year = None
+            self.cumulative = np.zeros((n_columns, 1), dtype=np.int64)
+            return
+        self.first_year = int(item_years[known].min())
+        self.last_year = int(item_years[known].max())
+        n_years = self.last_year - self.first_year + 1
+
+        # one entry per stored incidence: its column and its item's year
+        columns = np.repeat(np.arange(n_columns), np.diff(matrix.indptr))
+        dated = known[matrix.indices]
+        years = item_years[matrix.indices[dated]] - self.first_year
+        counts = np.bincount(
+            columns[dated] * n_years + years, minlength=n_columns * n_years
+        ).reshape(n_columns, n_years)
+        self.cumulative = np.zeros((n_columns, n_years + 1), dtype=np.int64)
+        np.cumsum(counts, axis=1, out=self.cumulative[:, 1:])
+
+    def range_counts(self, start: int, end: int) -> np.ndarray:
+        """
+        Number of items published from start to end (inclusive), for every
+        column.
+        """
+        if self.first_year is None:
+            return self.cumulative[:, 0]
+        n_years = self.cumulative.shape[1] - 1
+        lo = min(max(start - self.first_year, 0), n_years)
+        hi = min(max(end - self.first_year + 1, 0), n_years)
+        return self.cumulative[:, max(hi, lo)] - self.cumulative[:, lo]
+
+    def counts(self, attribute_ids, start: int, end: int) -> np.ndarray:
+        """
+        range_counts of the given attributes (0 for unknown ones).
+        """
+        in_range = self.range_counts(start, end)
+        return np.asarray(
+            [
+                in_range[self._column[a]] if a in self._column else 0
+                for a in attribute_ids
+            ],
+            dtype=np.int64,
+        )
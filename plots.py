@@ -1,23 +1,142 @@
+"""
+Figure factory for the frequency charts.
+
+The plot_* functions are pure: they never modify the frames they are given
+(those are often the cached frequency counts in st.session_state), and every
+figure they build is memoized on (chart, data version, max codes, label
+length, options such as the colour theme) in a bounded LRU cache shared by
+all sessions. A rerun caused by an unrelated widget then reuses the figure
+instead of building it again. Memoized figures are shared, so callers must
+treat them as read-only.
+"""
+
+import hashlib
+import threading
+
 import altair as alt
+import numpy as np
+import pandas as pd
 import plotly.express as px
+import plotly.graph_objects as go
 import streamlit as st
-from plotly.subplots import make_subplots
+from cachetools import LRUCache
 
+# number of figures kept by the figure factory
+FIGURE_CACHE_SIZE = 64
+# above this many bars, bar charts are drawn as one trace (see _single_trace_bar)
+SINGLE_TRACE_BARS = 20
+# above this many codes, small multiples are drawn as one horizontal bar trace
+SMALL_MULTIPLES_MAX = 40
+# attId of the "Other (k codes)" bucket of top_n
+OTHER_ATT_ID = -1
 
-def plot_freq_pie(df, title="Donut Chart", col_scale="Viridis", style="simple_white"):
-    df.sort_values(by=["Counts"], ascending=False, inplace=True)
-    if st.session_state.max_codes_slider_value < df.shape[0]:
-        df = df.head(st.session_state.max_codes_slider_value)
-    df["Codes"] = df["Codes"].apply(
-        lambda x: x[: st.session_state.max_length_int] + ".."
-        if isinstance(x, str) and len(x) > st.session_state.max_length_int
+_figure_cache = LRUCache(maxsize=FIGURE_CACHE_SIZE)
+_figure_cache_lock = threading.Lock()
+
+
+def data_version(df: pd.DataFrame) -> str:
+    """
+    Content hash of a df (its columns and the values of its rows, in order).
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update("\x1f".join(map(str, df.columns)).encode("utf-8"))
+    digest.update(pd.util.hash_pandas_object(df, index=False).to_numpy().tobytes())
+    return digest.hexdigest()
+
+
+def _memoized(build, df, **options):
+    """
+    build(df, max_codes, label_length, **options), memoized on the data
+    version of df, the display settings in st.session_state and options.
+    """
+    max_codes = st.session_state.max_codes_slider_value
+    label_length = st.session_state.max_length_int
+    key = (
+        build.__name__,
+        data_version(df),
+        max_codes,
+        label_length,
+        tuple(sorted(options.items())),
+    )
+    with _figure_cache_lock:
+        fig = _figure_cache.get(key)
+    if fig is None:
+        fig = build(df, max_codes, label_length, **options)
+        with _figure_cache_lock:
+            _figure_cache[key] = fig
+    return fig
+
+
+def _shorten(labels: pd.Series, label_length: int) -> pd.Series:
+    # labels longer than label_length are cut and end in ".."
+    return labels.map(
+        lambda x: x[:label_length] + ".."
+        if isinstance(x, str) and len(x) > label_length
         else x
     )
 
-    n_cols = df.shape[0]
-    colors = px.colors.sample_colorscale(
-        col_scale, [n / (n_cols - 1) for n in range(n_cols)]
+
+def _tail_mask(counts: np.ndarray, n: int) -> np.ndarray:
+    # True for all but the n largest counts, found by partial selection
+    tail = np.ones(len(counts), dtype=bool)
+    tail[np.argpartition(-counts, n - 1)[:n]] = False
+    return tail
+
+
+def top_n(df: pd.DataFrame, n: int) -> pd.DataFrame:
+    """
+    The n codes with the largest Counts, largest first. If there are more,
+    the rest are folded into one "Other (k codes)" row with their summed
+    counts and attId OTHER_ATT_ID (see resolve_other). The top codes are
+    found with np.argpartition, O(len(df)), and only they are sorted.
+    """
+    n = max(n, 1)
+    if df.shape[0] <= n:
+        return df.sort_values(by=["Counts"], ascending=False)
+    counts = df["Counts"].to_numpy()
+    tail = _tail_mask(counts, n)
+    top = np.flatnonzero(~tail)
+    top = top[np.argsort(-counts[top], kind="stable")]
+    other = pd.DataFrame(
+        {
+            "Codes": ["Other ({} codes)".format(int(tail.sum()))],
+            "Counts": [counts[tail].sum()],
+            "attId": [OTHER_ATT_ID],
+            "setId": [df["setId"].to_numpy()[tail][0]],
+        }
+    )
+    return pd.concat([df.iloc[top], other], ignore_index=True)
+
+
+def resolve_other(df: pd.DataFrame, n: int, idlist, setlist):
+    """
+    Replace a selected "Other" bucket of top_n(df, n) by the attIds and
+    setIds of all codes folded into it.
+
+    returns:
+        idlist, setlist
+    """
+    if OTHER_ATT_ID not in idlist or df.shape[0] <= max(n, 1):
+        return idlist, setlist
+    tail = _tail_mask(df["Counts"].to_numpy(), max(n, 1))
+    pairs = [(i, s) for i, s in zip(idlist, setlist) if i != OTHER_ATT_ID]
+    pairs += zip(
+        df["attId"].to_numpy()[tail].tolist(), df["setId"].to_numpy()[tail].tolist()
     )
+    return [i for i, _ in pairs], [s for _, s in pairs]
+
+
+def _sample_colors(col_scale, n_cols):
+    return px.colors.sample_colorscale(
+        col_scale, [n / max(n_cols - 1, 1) for n in range(n_cols)]
+    )
+
+
+def _freq_pie(df, max_codes, label_length, title, col_scale, style):
+    df = top_n(df, max_codes)
+    df = df.assign(Codes=_shorten(df["Codes"], label_length))
+
+    colors = _sample_colors(col_scale, df.shape[0])
     fig = px.pie(
         df,
         values="Counts",
@@ -35,28 +154,26 @@ def plot_freq_pie(df, title="Donut Chart", col_scale="Viridis", style="simple_wh
     return fig
 
 
-def plot_altair_freq_pie(
-    source, title="Donut Chart", col_scale="Viridis", style="simple_white"
-):
+def plot_freq_pie(df, title="Donut Chart", col_scale="Viridis", style="simple_white"):
+    return _memoized(_freq_pie, df, title=title, col_scale=col_scale, style=style)
+
+
+def _altair_freq_pie(source, max_codes, label_length, title, col_scale, style):
     # source = pd.DataFrame({
     #   'category': ['A', 'B', 'C', 'D'],
     #   'value': [20, 30, 15, 35]
     # })
 
-    if st.session_state.max_codes_slider_value < source.shape[0]:
-        source = source.head(st.session_state.max_codes_slider_value)
-    source["Code Names"] = source["Codes"]
-    source["Codes"] = source["Codes"].apply(
-        lambda x: x[: st.session_state.max_length_int] + ".."
-        if isinstance(x, str) and len(x) > st.session_state.max_length_int
-        else x
+    source = top_n(source, max_codes)
+    source = source.assign(
+        **{
+            "Code Names": source["Codes"],
+            "Codes": _shorten(source["Codes"], label_length),
+        }
     )
 
     custom_domain = source["Codes"]
-    n_cols = source.shape[0]
-    custom_colors = px.colors.sample_colorscale(
-        col_scale, [n / (n_cols - 1) for n in range(n_cols)]
-    )
+    custom_colors = _sample_colors(col_scale, source.shape[0])
 
     selector = alt.selection_point(
         on="click",
@@ -100,33 +217,72 @@ def plot_altair_freq_pie(
     return chart
 
 
-def plot_freq_bar(
+def plot_altair_freq_pie(
+    source, title="Donut Chart", col_scale="Viridis", style="simple_white"
+):
+    return _memoized(
+        _altair_freq_pie, source, title=title, col_scale=col_scale, style=style
+    )
+
+
+def _single_trace_bar(df, colors, title, style, x_axis, y_axis, plot_attributes):
+    """
+    Bar chart as one trace with a colour per bar, instead of the trace per
+    category px.bar makes for color=x_axis, so the figure's size and render
+    time hardly grow with the number of bars. customdata holds [attId, setId]
+    per bar, as the hover_data of px.bar does, so selections read the same.
+    """
+    hovertemplate = "{}=%{{x}}<br>{}=%{{y}}".format(x_axis, y_axis)
+    customdata = None
+    if plot_attributes:
+        customdata = df[["attId", "setId"]].to_numpy()
+        hovertemplate += "<br>attId=%{customdata[0]}<br>setId=%{customdata[1]}"
+    fig = go.Figure(
+        go.Bar(
+            x=df[x_axis],
+            y=df[y_axis],
+            marker_color=colors,
+            customdata=customdata,
+            hovertemplate=hovertemplate + "<extra></extra>",
+        )
+    )
+    fig.update_layout(
+        title=title,
+        template=style,
+        xaxis_title=x_axis,
+        yaxis_title=y_axis,
+        showlegend=False,
+    )
+    return fig
+
+
+def _freq_bar(
     df,
-    title="Bar Chart",
-    col_scale="Viridis",
-    style="simple_white",
-    x_axis="Codes",
-    y_axis="Counts",
-    plot_attributes=True,
-    sort_counts=True,
+    max_codes,
+    label_length,
+    title,
+    col_scale,
+    style,
+    x_axis,
+    y_axis,
+    plot_attributes,
+    sort_counts,
+    single_trace,
 ):
     if sort_counts:
-        df.sort_values(by=[y_axis], ascending=False, inplace=True)
+        df = top_n(df, max_codes)
     else:
-        df.sort_values(by=[x_axis], ascending=False, inplace=True)
-    if st.session_state.max_codes_slider_value < df.shape[0]:
-        df = df.head(st.session_state.max_codes_slider_value)
-    df[x_axis] = df[x_axis].apply(
-        lambda x: x[: st.session_state.max_length_int] + ".."
-        if isinstance(x, str) and len(x) > st.session_state.max_length_int
-        else x
-    )
+        df = df.sort_values(by=[x_axis], ascending=False).head(max_codes)
+    df = df.assign(**{x_axis: _shorten(df[x_axis], label_length)})
 
-    n_cols = df.shape[0]
-    colors = px.colors.sample_colorscale(
-        col_scale, [n / (n_cols - 1) for n in range(n_cols)]
-    )
-    if plot_attributes:
+    colors = _sample_colors(col_scale, df.shape[0])
+    if single_trace is None:
+        single_trace = df.shape[0] > SINGLE_TRACE_BARS
+    if single_trace:
+        fig = _single_trace_bar(
+            df, colors, title, style, x_axis, y_axis, plot_attributes
+        )
+    elif plot_attributes:
         fig = px.bar(
             df,
             y=y_axis,
@@ -154,87 +310,164 @@ def plot_freq_bar(
     return fig
 
 
-def plot_subplot_bar(df, title="Bar Chart", col_scale="Viridis", style="simple_white"):
-    df.sort_values(by=["Counts"], ascending=False, inplace=True)
-    n_cols = df.shape[0]
-    colors = px.colors.sample_colorscale(
-        col_scale, [n / (n_cols - 1) for n in range(n_cols)]
+def plot_freq_bar(
+    df,
+    title="Bar Chart",
+    col_scale="Viridis",
+    style="simple_white",
+    x_axis="Codes",
+    y_axis="Counts",
+    plot_attributes=True,
+    sort_counts=True,
+    single_trace=None,
+):
+    """
+    Bar chart of frequency counts, the max_codes_slider_value largest bars
+    and an "Other" bar for the rest (see top_n), or the latest bars if not
+    sort_counts, with labels cut to max_length_int.
+
+    args:
+        single_trace: draw all bars as one trace; None to do so only above
+            SINGLE_TRACE_BARS bars
+    """
+    return _memoized(
+        _freq_bar,
+        df,
+        title=title,
+        col_scale=col_scale,
+        style=style,
+        x_axis=x_axis,
+        y_axis=y_axis,
+        plot_attributes=plot_attributes,
+        sort_counts=sort_counts,
+        single_trace=single_trace,
     )
 
-    categories = []
-    for i, row in df.iterrows():
-        categories.append(
-            {
-                "Codes": row["Codes"],
-                "Counts": row["Counts"],
-                "SetId": row["setId"],
-                "AttributeId": row["attId"],
-            }
-        )
 
-    subplots = make_subplots(
-        rows=len(categories),
-        cols=1,
-        subplot_titles=[x["Codes"] for x in categories],
-        shared_xaxes=True,
-        print_grid=False,
-        vertical_spacing=(0.45 / len(categories)),
-    )
-    _ = subplots["layout"].update(
-        width=550,
-    )
-    for k, x in enumerate(categories):
-        subplots.add_trace(
-            dict(
-                type="bar",
+def _small_multiples(df, colors):
+    """
+    One horizontal bar subplot per code, titled with the code. Traces, axes
+    and titles are laid out in a single pass with precomputed domains (the
+    rows make_subplots would give), rather than by walking the layout
+    again for every trace.
+    """
+    n = df.shape[0]
+    spacing = 0.45 / n
+    row_height = (1 - spacing * (n - 1)) / n
+    size = max(45 * n, 350)
+    layout = {
+        "width": size,
+        "height": size,
+        "showlegend": False,
+        "margin": {"l": 0, "r": 0, "t": 20, "b": 1},
+        "annotations": [],
+    }
+    traces = []
+    rows = zip(
+        df["Codes"].tolist(),
+        df["Counts"].tolist(),
+        df["attId"].tolist(),
+        df["setId"].tolist(),
+        colors,
+    )
+    for k, (code, count, att_id, set_id, color) in enumerate(rows):
+        suffix = str(k + 1) if k > 0 else ""
+        top = 1 - k * (row_height + spacing)
+        traces.append(
+            go.Bar(
                 orientation="h",
-                y=[x["Codes"]],
-                x=[x["Counts"]],
-                text=[
-                    "attributeId: {}, setId: {}".format(x["AttributeId"], x["SetId"])
-                ],
+                y=[code],
+                x=[count],
+                text=["attributeId: {}, setId: {}".format(att_id, set_id)],
                 hoverinfo="text",
                 textposition="auto",
-                marker=dict(
-                    color=colors[k],
-                ),
-            ),
-            k + 1,
-            1,
+                marker={"color": color},
+                xaxis="x" + suffix,
+                yaxis="y" + suffix,
+            )
         )
+        layout["xaxis" + suffix] = {
+            "domain": [0, 1],
+            "anchor": "y" + suffix,
+            "matches": "x" if k > 0 else None,
+            "visible": False,
+        }
+        layout["yaxis" + suffix] = {
+            "domain": [max(top - row_height, 0), top],
+            "anchor": "x" + suffix,
+            "visible": False,
+        }
+        layout["annotations"].append(
+            {
+                "text": code,
+                "x": 0,
+                "xref": "paper",
+                "xanchor": "left",
+                "align": "left",
+                "y": top,
+                "yref": "paper",
+                "yanchor": "bottom",
+                "showarrow": False,
+                "font": {"size": 12},
+            }
+        )
+    return go.Figure(data=traces, layout=layout)
+
 
-        subplots["layout"].update(
-            showlegend=False,
+def _ranked_hbar(df, colors):
+    """
+    All codes as one horizontal bar trace, largest on top, for more codes
+    than small multiples can show. Bars sit at row positions with the codes
+    as tick labels, so codes sharing a name keep their own bars.
+    """
+    n = df.shape[0]
+    positions = list(range(n))
+    fig = go.Figure(
+        go.Bar(
+            orientation="h",
+            y=positions,
+            x=df["Counts"],
+            marker_color=colors,
+            customdata=df[["attId", "setId"]].to_numpy(),
+            text=df["Codes"],
+            hovertemplate="%{text}: %{x}<br>attributeId: %{customdata[0]}, "
+            "setId: %{customdata[1]}<extra></extra>",
+            textposition="none",
         )
-        for x in subplots["layout"]["annotations"]:
-            x["x"] = 0
-            x["xanchor"] = "left"
-            x["align"] = "left"
-            x["font"] = dict(
-                size=12,
-            )
+    )
+    fig.update_layout(
+        height=max(22 * n, 350),
+        showlegend=False,
+        margin={"l": 0, "r": 0, "t": 20, "b": 1},
+        yaxis={
+            "tickmode": "array",
+            "tickvals": positions,
+            "ticktext": df["Codes"].tolist(),
+            "autorange": "reversed",
+        },
+    )
+    return fig
 
-        for axis in subplots["layout"]:
-            if axis.startswith("yaxis") or axis.startswith("xaxis"):
-                subplots["layout"][axis]["visible"] = False
-        subplots["layout"]["margin"] = {
-            "l": 0,
-            "r": 0,
-            "t": 20,
-            "b": 1,
-        }
-        height_calc = 45 * len(categories)
-        height_calc = max([height_calc, 350])
-        subplots["layout"]["height"] = height_calc
-        subplots["layout"]["width"] = height_calc
-
-    # n_cols = df.shape[0]
-    # colors = px.colors.sample_colorscale(col_scale, [n / (n_cols - 1) for n in range(n_cols)])
-    # fig = px.bar(df, y='Counts', x='Codes',color='Codes', title=title, color_discrete_sequence=colors,
-    #              labels='inside', template=style)
-    # fig.update_layout(title_x=0.5)
-
-    return subplots
+
+def _subplot_bar(df, max_codes, label_length, title, col_scale, style):
+    df = df.sort_values(by=["Counts"], ascending=False)
+    colors = _sample_colors(col_scale, df.shape[0])
+    if df.shape[0] > SMALL_MULTIPLES_MAX:
+        fig = _ranked_hbar(df, colors)
+    else:
+        fig = _small_multiples(df, colors)
+    fig.update_layout(template=style)
+    return fig
+
+
+def plot_subplot_bar(df, title="Bar Chart", col_scale="Viridis", style="simple_white"):
+    """
+    Counts of all codes in df as small multiples (one bar per subplot), or
+    as one ranked horizontal bar trace above SMALL_MULTIPLES_MAX codes.
+    """
+    return _memoized(
+        _subplot_bar, df, title=title, col_scale=col_scale, style=style
+    )
 
 
 # def test_me():
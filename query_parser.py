@@ -0,0 +1,453 @@
+"""
+Parser and planner for the advanced free-text query syntax, e.g.
+
+    title:'AI equity'~5 AND abstract:(machine OR learn*)
+
+parse_query turns a query into an AST of Term, Phrase, And, Or and Not nodes.
+plan_query orders the operands of every AND by estimated cardinality (smallest
+first, exclusions last) and rewrites what the server cannot answer: a phrase
+with a proximity (~N) becomes an AND of its words, checked locally against the
+fetched titles/abstracts. execute_query then evaluates the plan as item-id set
+operations (see id_sets), pushing every term and exact phrase down to the
+server and stopping an AND as soon as its intermediate result is empty.
+"""
+
+import math
+import re
+
+import numpy as np
+from id_sets import EMPTY_IDS, and_ids, index_records, not_ids, or_ids
+
+# query field -> searchWhat value of ListFromCritJson
+FIELDS = {
+    "title": "Title",
+    "abstract": "Abstract",
+    "author": "Authors",
+    "authors": "Authors",
+    "any": "TitleAbstract",
+}
+DEFAULT_FIELD = "TitleAbstract"
+
+# searchWhat value -> record keys holding the text of that field
+RECORD_TEXT_KEYS = {
+    "Title": ("title",),
+    "Abstract": ("abstract",),
+    "Authors": ("authors",),
+    "TitleAbstract": ("title", "abstract"),
+}
+
+# a quote inside or at the end of a word (children's, students') is part of
+# the word; only a quote at the start of a token opens a phrase
+TOKEN_RE = re.compile(
+    r"""\s*(?:
+        (?P<lparen>\()
+        |(?P<rparen>\))
+        |(?P<phrase>'[^']*'|"[^"]*")
+        |(?P<slop>~\d+)
+        |(?P<field>\w+):
+        |(?P<word>[^\s()'"~]+(?:['"][^\s()'"~]*)*)
+    )""",
+    re.VERBOSE,
+)
+WORD_RE = re.compile(r"\w+")
+TAG_RE = re.compile(r"<[^>]+>")
+
+
+class QuerySyntaxError(ValueError):
+    """
+    Raised for queries that cannot be parsed or evaluated.
+    """
+
+
+class Term():
+    """
+    A single word in a field; prefix terms (learn*) match any word
+    starting with the text.
+    """
+
+    __slots__ = ("field", "text", "prefix")
+
+    def __init__(self, field, text, prefix=False):
+        self.field = field
+        self.text = text
+        self.prefix = prefix
+
+    def search_string(self):
+        return self.text + "*" if self.prefix else self.text
+
+    def __repr__(self):
+        return "{}:{}".format(self.field, self.search_string())
+
+
+class Phrase():
+    """
+    Words in a field, either consecutive (slop None) or all within slop
+    positions of each other.
+    """
+
+    __slots__ = ("field", "words", "slop")
+
+    def __init__(self, field, words, slop=None):
+        self.field = field
+        self.words = words
+        self.slop = slop
+
+    def search_string(self):
+        return '"{}"'.format(" ".join(self.words))
+
+    def __repr__(self):
+        slop = "" if self.slop is None else "~{}".format(self.slop)
+        return "{}:{}{}".format(self.field, self.search_string(), slop)
+
+
+class And():
+    __slots__ = ("children",)
+
+    def __init__(self, children):
+        self.children = children
+
+    def __repr__(self):
+        return "(" + " AND ".join(repr(c) for c in self.children) + ")"
+
+
+class Or():
+    __slots__ = ("children",)
+
+    def __init__(self, children):
+        self.children = children
+
+    def __repr__(self):
+        return "(" + " OR ".join(repr(c) for c in self.children) + ")"
+
+
+class Not():
+    __slots__ = ("child",)
+
+    def __init__(self, child):
+        self.child = child
+
+    def __repr__(self):
+        return "NOT {!r}".format(self.child)
+
+
+class Proximity():
+    """
+    Plan node: records matching candidates, filtered locally to those with
+    all words of the phrase within slop positions of each other.
+    """
+
+    __slots__ = ("candidates", "phrase")
+
+    def __init__(self, candidates, phrase):
+        self.candidates = candidates
+        self.phrase = phrase
+
+    def __repr__(self):
+        return "NEAR[{!r} IN {!r}]".format(self.phrase, self.candidates)
+
+
+def _tokenize(query):
+    tokens = []
+    pos = 0
+    query = query.rstrip()
+    while pos < len(query):
+        match = TOKEN_RE.match(query, pos)
+        if match is None or match.end() == pos:
+            raise QuerySyntaxError(
+                "Unexpected character at position {}: {}".format(pos, query[pos:])
+            )
+        kind = match.lastgroup
+        tokens.append((kind, match.group(kind)))
+        pos = match.end()
+    return tokens
+
+
+class _Parser():
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.pos = 0
+
+    def peek(self):
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else (None, None)
+
+    def next(self):
+        token = self.peek()
+        self.pos += 1
+        return token
+
+    def is_operator(self, name):
+        kind, value = self.peek()
+        return kind == "word" and value == name
+
+    def parse_or(self, field):
+        children = [self.parse_and(field)]
+        while self.is_operator("OR"):
+            self.next()
+            children.append(self.parse_and(field))
+        return children[0] if len(children) == 1 else Or(children)
+
+    def parse_and(self, field):
+        children = [self.parse_not(field)]
+        while True:
+            kind, _ = self.peek()
+            if self.is_operator("AND"):
+                self.next()
+            elif kind is None or kind == "rparen" or self.is_operator("OR"):
+                break
+            # juxtaposed terms are ANDed
+            children.append(self.parse_not(field))
+        return children[0] if len(children) == 1 else And(children)
+
+    def parse_not(self, field):
+        if self.is_operator("NOT"):
+            self.next()
+            return Not(self.parse_not(field))
+        return self.parse_primary(field)
+
+    def parse_primary(self, field):
+        kind, value = self.next()
+        if kind == "field":
+            if value.lower() not in FIELDS:
+                raise QuerySyntaxError(
+                    "Unknown field '{}', use one of: {}".format(
+                        value, ", ".join(FIELDS)
+                    )
+                )
+            return self.parse_primary(FIELDS[value.lower()])
+        if kind == "lparen":
+            node = self.parse_or(field)
+            if self.next()[0] != "rparen":
+                raise QuerySyntaxError("Missing closing bracket")
+            return node
+        if kind == "phrase":
+            words = WORD_RE.findall(value[1:-1])
+            if len(words) == 0:
+                raise QuerySyntaxError("Empty phrase {}".format(value))
+            slop = None
+            if self.peek()[0] == "slop":
+                slop = int(self.next()[1][1:])
+            if len(words) == 1 and slop is None:
+                return Term(field, words[0])
+            return Phrase(field, words, slop)
+        if kind == "word" and value not in ("AND", "OR", "NOT"):
+            # a trailing ~N on a single word has no meaning here, ignore it
+            if self.peek()[0] == "slop":
+                self.next()
+            if value.endswith("*") and len(value) > 1:
+                return Term(field, value.rstrip("*"), prefix=True)
+            return Term(field, value)
+        if kind is None:
+            raise QuerySyntaxError("Query ends unexpectedly")
+        raise QuerySyntaxError("Unexpected '{}'".format(value))
+
+
+def parse_query(query: str):
+    """
+    Parse a free-text query into an AST. Unfielded terms search
+    title and abstract; operators AND, OR and NOT are upper case, and
+    juxtaposed terms are ANDed.
+
+    raises:
+        QuerySyntaxError: if the query is malformed
+    """
+    tokens = _tokenize(query)
+    if len(tokens) == 0:
+        raise QuerySyntaxError("Empty query")
+    parser = _Parser(tokens)
+    node = parser.parse_or(DEFAULT_FIELD)
+    if parser.peek()[0] is not None:
+        raise QuerySyntaxError("Unexpected '{}'".format(parser.peek()[1]))
+    return node
+
+
+def cardinality_estimator(leaf_estimate):
+    """
+    Estimator for plan_query, built from an estimate for single terms and
+    exact phrases: AND takes its smallest positive operand, OR the sum of its
+    operands and a proximity check the estimate of its candidates. An
+    estimate of 0 must mean that nothing matches.
+
+    args:
+        leaf_estimate: callable(Term or Phrase) returning a number of records
+    """
+
+    def estimate(node) -> float:
+        if isinstance(node, (Term, Phrase)):
+            return leaf_estimate(node)
+        if isinstance(node, Proximity):
+            return estimate(node.candidates)
+        if isinstance(node, And):
+            return min(
+                estimate(c) for c in node.children if not isinstance(c, Not)
+            )
+        if isinstance(node, Or):
+            return sum(estimate(c) for c in node.children)
+        return math.inf
+
+    return estimate
+
+
+def _heuristic_leaf(node) -> float:
+    # exact phrases are rarer than single words, prefixes are broad
+    if isinstance(node, Phrase):
+        return 1000.0 / (2 ** len(node.words))
+    return 5000.0 if node.prefix else 1000.0
+
+
+# rough cardinalities for when nothing better is known
+heuristic_estimate = cardinality_estimator(_heuristic_leaf)
+
+
+def plan_query(node, estimate=heuristic_estimate):
+    """
+    Build an execution plan from an AST: AND operands are ordered by
+    estimate(node), smallest first, with NOT operands last; proximity
+    phrases become the AND of their words plus a local proximity check.
+
+    raises:
+        QuerySyntaxError: for a NOT that is not an operand of an AND with
+            a positive operand (NOT a, a OR NOT b)
+
+    args:
+        node: AST from parse_query
+        estimate: callable returning the estimated number of records
+            matching a plan node
+    """
+    if isinstance(node, Phrase) and node.slop is not None:
+        words = And([Term(node.field, w) for w in node.words])
+        return Proximity(plan_query(words, estimate), node)
+    if isinstance(node, Or):
+        return Or([plan_query(c, estimate) for c in node.children])
+    if isinstance(node, Not):
+        # only an AND with a positive operand has something to exclude from
+        raise QuerySyntaxError("NOT needs a term to exclude from, e.g. 'a NOT b'")
+    if isinstance(node, And):
+        positives = [
+            plan_query(c, estimate) for c in node.children if not isinstance(c, Not)
+        ]
+        negatives = [
+            Not(plan_query(c.child, estimate))
+            for c in node.children
+            if isinstance(c, Not)
+        ]
+        if len(positives) == 0:
+            raise QuerySyntaxError(
+                "NOT needs a term to exclude from, e.g. 'a NOT b'"
+            )
+        positives.sort(key=estimate)
+        negatives.sort(key=lambda c: estimate(c.child))
+        return And(positives + negatives)
+    return node
+
+
+def record_tokens(record, field):
+    """
+    Lower-cased words of each record key of the given field, tags stripped:
+    one list per key, so that word positions never run from the title on
+    into the abstract.
+    """
+    return [
+        WORD_RE.findall(TAG_RE.sub(" ", str(record.get(k) or "")).lower())
+        for k in RECORD_TEXT_KEYS[field]
+    ]
+
+
+def within_window(positions, window) -> bool:
+    """
+    True if one position of every list lies within window of one position
+    of the first list.
+    """
+    if any(len(p) == 0 for p in positions):
+        return False
+    for start in positions[0]:
+        if all(any(abs(p - start) < window for p in ps) for ps in positions[1:]):
+            return True
+    return False
+
+
+def proximity_match(tokens, words, slop) -> bool:
+    """
+    True if all words occur within a window of len(words) + slop tokens.
+    Words ending in * match as prefixes.
+    """
+    words = [w.lower() for w in words]
+    positions = [
+        [
+            i
+            for i, t in enumerate(tokens)
+            if (t.startswith(w[:-1]) if w.endswith("*") else t == w)
+        ]
+        for w in words
+    ]
+    return within_window(positions, len(words) + slop)
+
+
+def evaluate_plan(plan, leaf_ids, estimate=None) -> np.ndarray:
+    """
+    Evaluate a plan to a sorted array of itemIds, combining the ids of its
+    leaves by set operations.
+
+    args:
+        plan: plan from plan_query
+        leaf_ids: callable(node) returning the itemIds of a Term, Phrase or
+            Proximity node
+        estimate: optional estimator (see cardinality_estimator); nodes
+            estimated at 0 records are not evaluated at all
+    """
+    if estimate is not None and estimate(plan) == 0:
+        return EMPTY_IDS
+    if isinstance(plan, (Term, Phrase, Proximity)):
+        return leaf_ids(plan)
+    if isinstance(plan, Or):
+        return or_ids(*[evaluate_plan(c, leaf_ids, estimate) for c in plan.children])
+    if isinstance(plan, And):
+        result = None
+        for child in plan.children:
+            if result is not None and len(result) == 0:
+                # short-circuit: nothing left to intersect with or exclude from
+                break
+            if isinstance(child, Not):
+                result = not_ids(result, evaluate_plan(child.child, leaf_ids, estimate))
+            elif result is None:
+                result = evaluate_plan(child, leaf_ids, estimate)
+            else:
+                result = and_ids(result, evaluate_plan(child, leaf_ids, estimate))
+        return result if result is not None else EMPTY_IDS
+    raise QuerySyntaxError("NOT needs a term to exclude from, e.g. 'a NOT b'")
+
+
+def execute_query(
+    plan, fetch_leaf, record_store: dict, estimate=None
+) -> np.ndarray:
+    """
+    Evaluate a plan against the server to a sorted array of itemIds: terms
+    and exact phrases are fetched, proximity is checked on the records of
+    the candidates.
+
+    args:
+        plan: plan from plan_query
+        fetch_leaf: callable(field, search_string) returning the records the
+            server finds for a term or exact phrase
+        record_store: itemId -> record, filled with every fetched record
+        estimate: optional estimator (see cardinality_estimator); nodes
+            estimated at 0 records are not fetched at all
+    """
+
+    def leaf_ids(node):
+        if isinstance(node, Proximity):
+            candidates = evaluate_plan(node.candidates, leaf_ids, estimate)
+            phrase = node.phrase
+            keep = [
+                i
+                for i in candidates.tolist()
+                if any(
+                    proximity_match(tokens, phrase.words, phrase.slop)
+                    for tokens in record_tokens(record_store[i], phrase.field)
+                )
+            ]
+            return np.asarray(keep, dtype=np.int64)
+        return index_records(
+            fetch_leaf(node.field, node.search_string()), record_store
+        )
+
+    return evaluate_plan(plan, leaf_ids, estimate)
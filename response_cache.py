@@ -0,0 +1,184 @@
+"""
+Persistent cache of EPPI-Vis API responses, backed by a SQLite file.
+
+Responses are keyed by endpoint and normalised payload, so restarts and new
+worker processes come up warm. Entries expire after a per-call TTL, and the
+least recently used entries are evicted once the file exceeds its size cap.
+
+Configured through environment variables:
+    EPPI_VIS_CACHE_PATH: path of the SQLite file
+        (default: .eppi_vis_cache.sqlite next to this file)
+    EPPI_VIS_CACHE_MAX_MB: size cap in MB (default: 512)
+    EPPI_VIS_OFFLINE: "1" to serve only from the cache and never go to the
+        network, ignoring TTLs. Point EPPI_VIS_CACHE_PATH at a file recorded
+        during an online run to replay that snapshot.
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from pathlib import Path
+
+
+class OfflineCacheMiss(LookupError):
+    """
+    Raised in offline mode when a response is not in the cache.
+    """
+
+
+class ResponseCache():
+    """
+    SQLite-backed response store, safe to share between threads.
+    """
+
+    def __init__(self, path, max_bytes: int, offline: bool = False):
+        self.path = str(path)
+        self.max_bytes = max_bytes
+        self.offline = offline
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        # WAL lets several worker processes read while one writes; with WAL,
+        # synchronous=NORMAL makes a commit an append without an fsync
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                endpoint TEXT NOT NULL,
+                body BLOB NOT NULL,
+                size INTEGER NOT NULL,
+                stored_at REAL NOT NULL,
+                last_access REAL NOT NULL
+            )
+            """
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)"
+        )
+        self._conn.commit()
+        # running total of the stored body sizes, so a put needs no table scan
+        self._total = self._stored_bytes()
+
+    def _stored_bytes(self) -> int:
+        return self._conn.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM responses"
+        ).fetchone()[0]
+
+    @staticmethod
+    def key(method: str, endpoint: str, payload=None) -> str:
+        """
+        Cache key for a request. Payload values are compared as strings, since
+        that is how they are form-encoded on the wire.
+        """
+        normalised = sorted((str(k), str(v)) for k, v in (payload or {}).items())
+        raw = json.dumps([method.upper(), endpoint, normalised])
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def get(self, key: str, ttl: float):
+        """
+        Cached response text for key, or None if missing or older than ttl
+        seconds. In offline mode entries never expire.
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT body, stored_at FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            body, stored_at = row
+            if not self.offline and time.time() - stored_at > ttl:
+                return None
+            self._conn.execute(
+                "UPDATE responses SET last_access = ? WHERE key = ?", (time.time(), key)
+            )
+            self._conn.commit()
+        return zlib.decompress(body).decode("utf-8")
+
+    def put(self, key: str, endpoint: str, text: str):
+        """
+        Store a response text and evict least recently used entries beyond the
+        size cap.
+        """
+        body = zlib.compress(text.encode("utf-8"))
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT size FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)",
+                (key, endpoint, body, len(body), now, now),
+            )
+            self._total += len(body) - (row[0] if row is not None else 0)
+            if self._total > self.max_bytes:
+                self._evict()
+            self._conn.commit()
+
+    def _evict(self):
+        # other processes may have written to the file too: recount before
+        # deleting anything
+        total = self._stored_bytes()
+        stale = []
+        for key, size in self._conn.execute(
+            "SELECT key, size FROM responses ORDER BY last_access ASC"
+        ):
+            if total <= self.max_bytes:
+                break
+            stale.append((key,))
+            total -= size
+        self._conn.executemany("DELETE FROM responses WHERE key = ?", stale)
+        self._total = total
+
+    def iter_texts(self, endpoints):
+        """
+        Response texts of all cached responses of the given endpoints,
+        regardless of their age. Bodies are read one at a time, so neither
+        memory nor the lock is held for all of them at once.
+        """
+        with self._lock:
+            keys = self._conn.execute(
+                "SELECT key FROM responses WHERE endpoint IN ({})".format(
+                    ",".join("?" * len(endpoints))
+                ),
+                tuple(endpoints),
+            ).fetchall()
+        for (key,) in keys:
+            with self._lock:
+                row = self._conn.execute(
+                    "SELECT body FROM responses WHERE key = ?", (key,)
+                ).fetchone()
+            if row is not None:
+                yield zlib.decompress(row[0]).decode("utf-8")
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM responses")
+            self._conn.commit()
+            self._total = 0
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_response_cache() -> ResponseCache:
+    """
+    The process-wide ResponseCache, created from the environment on first use.
+    """
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = ResponseCache(
+                os.environ.get(
+                    "EPPI_VIS_CACHE_PATH",
+                    os.path.join(Path(__file__).parent, ".eppi_vis_cache.sqlite"),
+                ),
+                max_bytes=int(float(os.environ.get("EPPI_VIS_CACHE_MAX_MB", 512)) * 2**20),
+                offline=os.environ.get("EPPI_VIS_OFFLINE", "0") == "1",
+            )
+        return _cache
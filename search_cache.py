@@ -0,0 +1,91 @@
+"""
+Process-wide memo of boolean search results, shared by all sessions.
+
+Two caches hold itemId arrays together with the records of those ids:
+    arm cache: the result of a single search arm, keyed by the normalised
+        arm (its sorted attributes, or its whitespace-normalised query)
+    prefix cache: the combined result of arms 1..N, keyed by the sequence of
+        (operator, normalised arm), plus the search documentation lines
+
+Adding an arm to a search then only evaluates the new arm and combines it
+with the cached result of the arms before it. Entries expire with the
+response cache TTL and the least recently used ones are evicted once the
+cached results hold more than SEARCH_CACHE_MAX_RECORDS records.
+"""
+
+import threading
+
+from cachetools import TTLCache
+from eppi_client import RESPONSE_CACHE_TTL
+
+# bound for the number of records (summed over entries) each cache holds
+SEARCH_CACHE_MAX_RECORDS = 200000
+
+
+def arm_key(attributes, query: str = ""):
+    """
+    Normalised key of a search arm: the sorted (AttributeId, SetId) pairs of
+    its attributes, else its query with whitespace collapsed.
+    """
+    if len(attributes) > 0:
+        return (
+            "codes",
+            tuple(sorted({(a.AttributeId, a.SetId) for a in attributes})),
+        )
+    if len(query.strip()) > 0:
+        return ("text", " ".join(query.split()))
+    return ("empty",)
+
+
+class SearchResultCache():
+    """
+    Thread-safe LRU/TTL cache of (itemIds, records, ...) entries, sized by
+    the number of itemIds.
+    """
+
+    def __init__(
+        self, max_records: int = SEARCH_CACHE_MAX_RECORDS, ttl=RESPONSE_CACHE_TTL
+    ):
+        self._lock = threading.Lock()
+        self._cache = TTLCache(
+            maxsize=max_records,
+            ttl=ttl,
+            getsizeof=lambda entry: max(1, len(entry[0])),
+        )
+
+    def get(self, key):
+        with self._lock:
+            return self._cache.get(key)
+
+    def put(self, key, ids, record_store: dict, *extra):
+        """
+        Store ids with their records from record_store; extra values are
+        kept with the entry. Entries larger than the cache are not stored.
+        """
+        entry = (ids, {i: record_store[i] for i in ids.tolist()}) + extra
+        with self._lock:
+            try:
+                self._cache[key] = entry
+            except ValueError:
+                # too large for the cache
+                pass
+
+    def longest_prefix(self, keys):
+        """
+        Length and entry of the longest cached prefix of keys, (0, None)
+        if there is none.
+        """
+        with self._lock:
+            for k in range(len(keys), 0, -1):
+                entry = self._cache.get(tuple(keys[:k]))
+                if entry is not None:
+                    return k, entry
+        return 0, None
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+
+arm_cache = SearchResultCache()
+prefix_cache = SearchResultCache()
@@ -1,7 +1,6 @@
 import os
 from pathlib import Path
 
-import requests
 import streamlit as st
 from all_pages.pg_1 import demo_p1
 from all_pages.pg_2 import demo_p2
@@ -12,26 +11,28 @@ from all_pages.pg_dashboard import dashbd
 from all_pages.pg_home import home
 from all_pages.pg_record_view import view_records
 from api_calls import get_all_attributes, get_year_histogram
+from eppi_client import EPPI_BASE_URL, get_webdb_client
 from utils import initialise_state
 
 
-def update_ui(session, cookie):
+def update_ui(client):
     """
     The primary function used to display a Streamlit application for an EPPI visualisation demo.
 
     Args:
-        session: A requests session connecting to the EPPI-Vis API. Used for further queries.
-        cookie: A login cookie for the session.
+        client: A logged-in EppiVisClient connecting to the EPPI-Vis API. Used for further queries.
     """
 
     # store information upon application launch
-    if st.session_state.get("session") is None:
-        st.session_state.eppi_base_url = "https://eppi.ioe.ac.uk"
+    if st.session_state.get("client") is None:
+        st.session_state.eppi_base_url = EPPI_BASE_URL
         st.session_state.eppi_icon = os.path.join(
             Path(__file__).parent, "resources/EPPI_small_logo.png"
         )
-        st.session_state.session = session
-        st.session_state.cookie = cookie
+        st.session_state.client = client
+        # plain session and cookie, for pages that fetch html rather than the api
+        st.session_state.session = client.session
+        st.session_state.cookie = client.cookie
         get_all_attributes()  # retrieve all and store in session state as list of attribute objects
         get_year_histogram()
 
@@ -73,12 +74,11 @@ def update_ui(session, cookie):
 def main():
     # set up session
     initialise_state()  # initialises some session state variables
-    session = requests.session()
-    session.get("https://eppi.ioe.ac.uk/EPPI-Vis/Login/Open?WebDBid=536")
-    # get login cookie
-    cookie = session.cookies["WebDbErLoginCookie"]
+    # logged-in client shared by all sessions; reruns don't log in again
+    # unless the cookie has expired
+    client = get_webdb_client(536)
     # display ui
-    update_ui(session, cookie)
+    update_ui(client)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,120 @@
+"""
+Set algebra over itemId arrays: the operators must agree with Python sets,
+arms_to_fetch must only skip arms that cannot change a search, and a
+ResultHandle fingerprint must change with anything a cached export shows.
+"""
+
+import random
+
+import numpy as np
+import pandas as pd
+import pytest
+from id_sets import (
+    EMPTY_IDS,
+    ResultHandle,
+    and_ids,
+    apply_operator,
+    arms_to_fetch,
+    frame_fingerprint,
+    index_records,
+    not_ids,
+    or_ids,
+    records_frame,
+    to_id_array,
+)
+
+
+def _random_sets(n, seed):
+    rng = random.Random(seed)
+    return [set(rng.sample(range(1, 60), rng.randint(0, 30))) for _ in range(n)]
+
+
+def _ids(values):
+    return np.asarray(sorted(values), dtype=np.int64)
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_operators_match_python_sets(seed):
+    sets = _random_sets(4, seed)
+    arrays = [to_id_array(s) for s in sets]
+
+    np.testing.assert_array_equal(and_ids(*arrays), _ids(set.intersection(*sets)))
+    np.testing.assert_array_equal(or_ids(*arrays), _ids(set.union(*sets)))
+    np.testing.assert_array_equal(
+        not_ids(arrays[0], *arrays[1:]), _ids(sets[0] - set.union(*sets[1:]))
+    )
+    for operator, expected in [
+        ("AND", sets[0] & sets[1] & sets[2]),
+        ("OR", sets[0] | sets[1] | sets[2]),
+        ("NOT", sets[0] - sets[1] - sets[2]),
+    ]:
+        np.testing.assert_array_equal(
+            apply_operator(arrays[0], arrays[1:3], operator), _ids(expected)
+        )
+
+
+def test_empty_operands():
+    ids = _ids({3, 1, 2})
+    assert len(and_ids()) == 0 and len(or_ids()) == 0
+    np.testing.assert_array_equal(not_ids(ids), ids)
+    assert len(and_ids(ids, EMPTY_IDS)) == 0
+    np.testing.assert_array_equal(or_ids(ids, EMPTY_IDS), ids)
+
+
+def _evaluate(sets, operators):
+    # left to right, as the query builder shows it
+    result = sets[0]
+    for s, operator in zip(sets[1:], operators[1:]):
+        result = {"AND": result & s, "OR": result | s, "NOT": result - s}[operator]
+    return result
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_arms_to_fetch_skips_only_irrelevant_arms(seed):
+    rng = random.Random(seed)
+    sets = _random_sets(5, seed)
+    for s in rng.sample(sets, 2):
+        s.clear()
+    operators = [""] + [rng.choice(["AND", "OR", "NOT"]) for _ in sets[1:]]
+
+    fetch = arms_to_fetch([len(s) for s in sets], operators)
+    fetched = [s if f else set() for s, f in zip(sets, fetch)]
+    assert _evaluate(fetched, operators) == _evaluate(sets, operators)
+    assert not any(f for s, f in zip(sets, fetch) if len(s) == 0)
+
+
+def test_arms_to_fetch_unknown_counts():
+    assert arms_to_fetch([None, 3, None], ["", "AND", "OR"]) == [True] * 3
+    assert arms_to_fetch([None, 3, 0], ["", "OR", "AND"]) == [False] * 3
+    assert arms_to_fetch([None, 3, 0], ["", "OR", "NOT"]) == [True, True, False]
+
+
+def test_index_records_keeps_first_record():
+    store = {}
+    ids = index_records([{"itemId": 2, "v": "a"}, {"itemId": 1}], store)
+    index_records([{"itemId": 2, "v": "b"}], store)
+
+    np.testing.assert_array_equal(ids, [1, 2])
+    assert store[2]["v"] == "a"
+    frame = records_frame(ids, store, ["itemId", "v"])
+    assert list(frame.columns) == ["itemId", "v"] and frame.shape == (2, 2)
+
+
+def test_result_handle_fingerprint():
+    df = pd.DataFrame({"itemId": [1, 2, 3], "title": ["a", "b", "c"]})
+    handle = ResultHandle.of_frame(df)
+
+    assert handle.fingerprint == frame_fingerprint(df.copy())
+    changed = [
+        df.iloc[::-1],
+        pd.concat([df, df.iloc[:1]]),
+        df.assign(title=["a", "b", "x"]),
+        df[["itemId"]],
+    ]
+    for other in changed:
+        assert frame_fingerprint(other) != handle.fingerprint
+    np.testing.assert_array_equal(handle.ids, [1, 2, 3])
+    with pytest.raises(AttributeError):
+        handle.fingerprint = "x"
+    with pytest.raises(ValueError):
+        handle.ids[0] = 5
@@ -0,0 +1,112 @@
+"""
+Code arms must give the same itemIds whether they are pushed down to the
+server (conjunction_ids), evaluated arm by arm (records_for_codes), or
+combined with a cached prefix of the search. The server is simulated with
+paged with/without-codes searches over random codings, with more records
+per code than fit on one page.
+"""
+
+import random
+
+import api_calls
+import numpy as np
+import pytest
+import streamlit as st
+from data_definitions import Attribute
+from id_sets import apply_operator, index_records
+from text_index import TextIndex
+
+N_ITEMS = 1000
+CODES = [Attribute(a, "code {}".format(a), SetId=7) for a in range(1, 6)]
+
+
+class FakeClient():
+    # answers the record list endpoints from itemId -> set of AttributeIds
+
+    def __init__(self, coding):
+        self.coding = coding
+
+    def _matches(self, with_ids, without_ids):
+        def ids(value):
+            return {int(a) for a in value.split(",") if a}
+
+        with_ids, without_ids = ids(with_ids), ids(without_ids)
+        return [
+            {"itemId": item, "title": "record {}".format(item)}
+            for item, codes in sorted(self.coding.items())
+            if with_ids <= codes and not without_ids & codes
+        ]
+
+    def request_json(self, method, endpoint, payload):
+        if endpoint == "ItemList/GetListWithWithoutAttsJSON":
+            records = self._matches(payload["WithAttIds"], payload["WithoutAttIds"])
+            page = records[: api_calls.RECORDS_PAGE_SIZE]
+        else:
+            records = self._matches(
+                payload["withAttributesIds"], payload["withOutAttributesIdsList"]
+            )
+            start = payload["pageNumber"] * payload["pageSize"]
+            page = records[start : start + payload["pageSize"]]
+        return {"items": {"items": page, "totalItemCount": len(records)}}
+
+
+@pytest.fixture
+def server(monkeypatch):
+    rng = random.Random(3)
+    coding = {
+        item: {a.AttributeId for a in CODES if rng.random() < 0.5}
+        for item in range(1, N_ITEMS + 1)
+    }
+    client = FakeClient(coding)
+    monkeypatch.setattr(api_calls, "get_client", lambda: client)
+    monkeypatch.setattr(api_calls, "get_text_index", TextIndex)
+    st.session_state.frequency_counts = {}
+    st.session_state.search_info_retrieval = []
+    return coding
+
+
+def _arm_by_arm(arms):
+    result = None
+    for operator, attributes in arms:
+        arm_ids = index_records(api_calls.records_for_codes(attributes), {})
+        if result is None:
+            result = arm_ids
+        else:
+            result = apply_operator(result, [arm_ids], operator)
+    return result
+
+
+def _pushed(arms, max_requests=api_calls.PUSHDOWN_MAX_REQUESTS):
+    with_groups = [atts for operator, atts in arms if operator != "NOT"]
+    without_atts = [a for operator, atts in arms if operator == "NOT" for a in atts]
+    return api_calls.conjunction_ids(with_groups, without_atts, {}, max_requests)[0]
+
+
+ARMS = [
+    ("", [CODES[0]]),
+    ("AND", [CODES[1], CODES[2]]),
+    ("AND", [CODES[3]]),
+    ("NOT", [CODES[4]]),
+]
+
+
+@pytest.mark.parametrize("max_requests", [1, api_calls.PUSHDOWN_MAX_REQUESTS])
+def test_pushdown_matches_arm_by_arm(server, max_requests):
+    expected = [
+        item
+        for item, codes in sorted(server.items())
+        if 1 in codes and codes & {2, 3} and 4 in codes and 5 not in codes
+    ]
+    np.testing.assert_array_equal(_arm_by_arm(ARMS), expected)
+    np.testing.assert_array_equal(_pushed(ARMS, max_requests), expected)
+
+
+@pytest.mark.parametrize("prefix", [2, 3])
+def test_cached_prefix_matches_full_search(server, prefix):
+    # a cached (pushed down) prefix, extended by the later arms one by one
+    result = _pushed(ARMS[:prefix])
+    for operator, attributes in ARMS[prefix:]:
+        arm_ids = index_records(api_calls.records_for_codes(attributes), {})
+        result = apply_operator(result, [arm_ids], operator)
+    np.testing.assert_array_equal(result, _pushed(ARMS))
+    np.testing.assert_array_equal(result, _arm_by_arm(ARMS))
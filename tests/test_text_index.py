@@ -0,0 +1,93 @@
+"""
+The local text index must answer queries exactly as the server-side
+evaluator (query_parser.execute_query) does. The server is simulated by
+matching terms and exact phrases on the tokens of each record field.
+"""
+
+import random
+
+import numpy as np
+import pytest
+from query_parser import RECORD_TEXT_KEYS, execute_query, parse_query, plan_query
+from text_index import TextIndex, tokenize
+
+WORDS = ["equity", "ai", "health", "children", "learning", "machine", "policy"]
+
+
+def _corpus(n=400, seed=1):
+    rng = random.Random(seed)
+    return [
+        {
+            "itemId": i,
+            "title": " ".join(rng.choices(WORDS, k=rng.randint(1, 4))),
+            "abstract": " ".join(rng.choices(WORDS, k=rng.randint(0, 12))),
+        }
+        for i in range(1, n + 1)
+    ]
+
+
+def _server(records):
+    # records a term or exact phrase search of the server would return
+    def fetch_leaf(field, search_string):
+        prefix = search_string.endswith("*")
+        words = tokenize(search_string.rstrip("*"))
+        hits = []
+        for record in records:
+            for key in RECORD_TEXT_KEYS[field]:
+                tokens = tokenize(record.get(key))
+                if prefix:
+                    found = any(t.startswith(words[0]) for t in tokens)
+                else:
+                    found = any(
+                        tokens[j : j + len(words)] == words
+                        for j in range(len(tokens) - len(words) + 1)
+                    )
+                if found:
+                    hits.append(record)
+                    break
+        return hits
+
+    return fetch_leaf
+
+
+@pytest.mark.parametrize(
+    "query",
+    [
+        "equity",
+        "equity ai",
+        "'equity ai'",
+        "'equity ai'~0",
+        "'ai equity'~2",
+        "title:'health children'~1",
+        "abstract:learn* NOT policy",
+        "(machine OR policy) AND title:ai",
+        "children's health",
+    ],
+)
+def test_index_matches_server(query):
+    records = _corpus()
+    index = TextIndex()
+    index.add_records(records)
+    node = parse_query(query)
+    assert index.covers(node)
+
+    local_ids, _ = index.search(node)
+    server_ids = execute_query(plan_query(node), _server(records), {})
+    np.testing.assert_array_equal(local_ids, server_ids)
+
+
+def test_proximity_does_not_cross_fields():
+    records = [{"itemId": 1, "title": "ai", "abstract": "equity now"}]
+    index = TextIndex()
+    index.add_records(records)
+    node = parse_query("'ai equity'~0")
+
+    assert len(index.search(node)[0]) == 0
+    assert len(execute_query(plan_query(node), _server(records), {})) == 0
+
+
+def test_index_is_bounded():
+    index = TextIndex(max_records=10)
+    assert index.add_records(_corpus(n=25)) == 10
+    assert len(index) == 10 and index.full
+    assert set(index.record(1)) >= {"itemId", "title", "abstract"}
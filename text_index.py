@@ -0,0 +1,313 @@
+"""
+Local inverted index over the titles and abstracts of the records we have
+fetched, for answering free-text queries without the server.
+
+Every posting is one int64 encoding (itemId, field, position), appended to a
+per-term array("q"), so the index takes 8 bytes per indexed word and grows
+incrementally as records arrive. Queries are parsed and planned by
+query_parser and evaluated here on the postings:
+    term: items with a posting of the term in the field
+    prefix (learn*): union over the terms with that prefix (sorted term list)
+    exact phrase: postings of word j shifted back by j positions, intersected
+    proximity (~N): items with all words, checked for the window per field
+
+Records are kept as tuples of RECORD_FIELDS (what the record views and
+exports show), and at most TEXT_INDEX_MAX_RECORDS of them are indexed. On
+first use a background thread fills the index from the record lists in the
+persistent response cache, so it also serves offline runs
+(EPPI_VIS_OFFLINE=1) once that is done.
+"""
+
+import json
+import threading
+from array import array
+from bisect import bisect_left
+
+import numpy as np
+from id_sets import EMPTY_IDS
+from query_parser import (
+    Phrase,
+    Proximity,
+    Term,
+    TAG_RE,
+    WORD_RE,
+    cardinality_estimator,
+    evaluate_plan,
+    plan_query,
+    within_window,
+)
+from response_cache import get_response_cache
+
+# indexed fields: code -> record key
+INDEX_FIELDS = {0: "title", 1: "abstract"}
+# searchWhat value -> codes of the indexed fields it searches
+SEARCH_FIELDS = {"Title": (0,), "Abstract": (1,), "TitleAbstract": (0, 1)}
+
+POSITION_BITS = 20  # words beyond the first 2**20 of a field are not indexed
+FIELD_BITS = 1
+ITEM_SHIFT = POSITION_BITS + FIELD_BITS
+POSITION_MASK = (1 << POSITION_BITS) - 1
+
+# record keys kept per indexed record
+RECORD_FIELDS = (
+    "itemId",
+    "title",
+    "shortTitle",
+    "abstract",
+    "authors",
+    "year",
+    "typeName",
+    "parentTitle",
+    "volume",
+    "issue",
+    "pages",
+    "publisher",
+    "city",
+    "standardNumber",
+    "doi",
+    "url",
+    "quickCitation",
+)
+# bound for the number of indexed records; later records are not indexed
+TEXT_INDEX_MAX_RECORDS = 200000
+
+# response cache endpoints whose responses hold record lists
+RECORD_ENDPOINTS = (
+    "ItemList/ListFromCritJson",
+    "ItemList/GetListWithWithoutAttsJSON",
+    "ItemList/GetFreqListJSON",
+)
+
+
+def tokenize(text) -> list:
+    """
+    Lower-cased words of a text, tags stripped (as query_parser.record_tokens).
+    """
+    return WORD_RE.findall(TAG_RE.sub(" ", str(text or "")).lower())
+
+
+class TextIndex():
+    """
+    Positional inverted index over title and abstract, safe to share between
+    threads. Keeps the RECORD_FIELDS of the indexed records, so local results
+    can be shown.
+
+    args:
+        max_records: bound for the number of indexed records
+    """
+
+    def __init__(self, max_records: int = TEXT_INDEX_MAX_RECORDS):
+        self.max_records = max_records
+        self._lock = threading.Lock()
+        self._postings = {}  # term -> array("q") of encoded postings
+        self._records = {}  # itemId -> tuple of RECORD_FIELDS values
+        self._terms = None  # sorted terms, rebuilt after new terms arrive
+        # set once the records of the response cache are indexed
+        self.synced = threading.Event()
+
+    def __len__(self):
+        return len(self._records)
+
+    def __contains__(self, item_id):
+        return item_id in self._records
+
+    @property
+    def full(self) -> bool:
+        return len(self._records) >= self.max_records
+
+    def record(self, item_id) -> dict:
+        """
+        The kept fields of an indexed record.
+
+        raises:
+            KeyError: if the record is not indexed
+        """
+        return dict(zip(RECORD_FIELDS, self._records[item_id]))
+
+    def add_records(self, records) -> int:
+        """
+        Index the records not indexed yet, while there is room.
+
+        returns:
+            number of newly indexed records
+        """
+        added = 0
+        with self._lock:
+            for record in records:
+                item_id = record.get("itemId")
+                if item_id is None or item_id in self._records:
+                    continue
+                if len(self._records) >= self.max_records:
+                    break
+                self._records[item_id] = tuple(record.get(k) for k in RECORD_FIELDS)
+                added += 1
+                for code, key in INDEX_FIELDS.items():
+                    base = (item_id << ITEM_SHIFT) | (code << POSITION_BITS)
+                    for position, term in enumerate(tokenize(record.get(key))):
+                        if position > POSITION_MASK:
+                            break
+                        postings = self._postings.get(term)
+                        if postings is None:
+                            postings = self._postings[term] = array("q")
+                            self._terms = None
+                        postings.append(base | position)
+        return added
+
+    def _matching_terms(self, text, prefix):
+        if not prefix:
+            return [text] if text in self._postings else []
+        if self._terms is None:
+            self._terms = sorted(self._postings)
+        terms = []
+        for term in self._terms[bisect_left(self._terms, text) :]:
+            if not term.startswith(text):
+                break
+            terms.append(term)
+        return terms
+
+    def postings(self, text, field, prefix=False) -> np.ndarray:
+        """
+        Encoded postings of a term (or all terms with the prefix) in the
+        fields searched by field, as a copy.
+        """
+        with self._lock:
+            arrays = [
+                np.array(self._postings[t], dtype=np.int64)
+                for t in self._matching_terms(text.lower(), prefix)
+            ]
+        if len(arrays) == 0:
+            return EMPTY_IDS
+        postings = np.concatenate(arrays)
+        codes = (postings >> POSITION_BITS) & ((1 << FIELD_BITS) - 1)
+        return postings[np.isin(codes, SEARCH_FIELDS[field])]
+
+    def covers(self, node) -> bool:
+        """
+        True if all fields of a query AST are indexed.
+        """
+        if isinstance(node, Term) and node.prefix:
+            # a prefix is looked up as one word
+            return node.field in SEARCH_FIELDS and len(tokenize(node.text)) == 1
+        if isinstance(node, (Term, Phrase)):
+            return node.field in SEARCH_FIELDS
+        if isinstance(node, Proximity):
+            return self.covers(node.phrase)
+        children = getattr(node, "children", None) or [node.child]
+        return all(self.covers(c) for c in children)
+
+    @staticmethod
+    def _as_phrase(node):
+        # a term spanning several indexed words (children's) is their phrase
+        if isinstance(node, Term) and not node.prefix:
+            words = tokenize(node.text)
+            if len(words) != 1:
+                return Phrase(node.field, words)
+        return node
+
+    def _leaf_count(self, node) -> int:
+        # number of postings, an upper bound of the matching records
+        node = self._as_phrase(node)
+        if isinstance(node, Phrase) and len(node.words) == 0:
+            return 0
+        if isinstance(node, Phrase):
+            return min(len(self.postings(w, node.field)) for w in node.words)
+        return len(self.postings(node.text, node.field, node.prefix))
+
+    def _leaf_ids(self, node) -> np.ndarray:
+        node = self._as_phrase(node)
+        if isinstance(node, Phrase) and len(node.words) == 0:
+            return EMPTY_IDS
+        if isinstance(node, Term):
+            postings = self.postings(node.text, node.field, node.prefix)
+            return np.unique(postings >> ITEM_SHIFT)
+        phrase = node.phrase if isinstance(node, Proximity) else node
+        word_postings = [self.postings(w, phrase.field) for w in phrase.words]
+        if phrase.slop is None:
+            starts = None
+            for j, postings in enumerate(word_postings):
+                postings = postings[(postings & POSITION_MASK) >= j] - j
+                starts = (
+                    np.unique(postings)
+                    if starts is None
+                    else np.intersect1d(starts, postings)
+                )
+            return np.unique(starts >> ITEM_SHIFT)
+        return self._proximity_ids(word_postings, len(phrase.words) + phrase.slop)
+
+    def _proximity_ids(self, word_postings, window) -> np.ndarray:
+        # postings sorted by (item, field) slot, so the positions of a slot
+        # are a contiguous run
+        word_postings = [np.sort(postings) for postings in word_postings]
+        slots = [postings >> POSITION_BITS for postings in word_postings]
+        # candidates: slots holding every word
+        candidates = np.unique(slots[0])
+        for s in slots[1:]:
+            candidates = np.intersect1d(candidates, s)
+        bounds = [
+            (
+                np.searchsorted(s, candidates, "left"),
+                np.searchsorted(s, candidates, "right"),
+            )
+            for s in slots
+        ]
+        keep = set()
+        for k, slot in enumerate(candidates.tolist()):
+            positions = [
+                (postings[lo[k] : hi[k]] & POSITION_MASK).tolist()
+                for postings, (lo, hi) in zip(word_postings, bounds)
+            ]
+            if within_window(positions, window):
+                keep.add(slot >> FIELD_BITS)
+        return np.asarray(sorted(keep), dtype=np.int64)
+
+    def search(self, node):
+        """
+        Evaluate a query AST (see query_parser.parse_query) on the index.
+
+        returns:
+            sorted array of itemIds, the executed plan
+        """
+        estimate = cardinality_estimator(self._leaf_count)
+        plan = plan_query(node, estimate)
+        return evaluate_plan(plan, self._leaf_ids, estimate), plan
+
+    def sync_from_cache(self) -> int:
+        """
+        Index the records of all record lists in the response cache (until
+        the index is full), then set synced.
+
+        returns:
+            number of newly indexed records
+        """
+        added = 0
+        try:
+            for text in get_response_cache().iter_texts(RECORD_ENDPOINTS):
+                if self.full:
+                    break
+                try:
+                    records = json.loads(text)["items"]["items"]
+                except (ValueError, KeyError, TypeError):
+                    continue
+                added += self.add_records(records)
+        finally:
+            self.synced.set()
+        return added
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_text_index() -> TextIndex:
+    """
+    The process-wide TextIndex. On first use it is returned right away and
+    filled from the response cache by a background thread (see synced).
+    """
+    global _index
+    with _index_lock:
+        if _index is None:
+            _index = TextIndex()
+            threading.Thread(
+                target=_index.sync_from_cache, name="text-index-sync", daemon=True
+            ).start()
+        return _index
@@ -1,6 +1,10 @@
 import pandas as pd
 import streamlit as st
 import streamlit_antd_components as sac
+from api_calls import selection_pages
+from eppi_client import RESPONSE_CACHE_TTL
+from exports import EXPORT_FORMATS, export_bytes, export_file
+from id_sets import frame_fingerprint
 
 def initialise_state():
     if "max_length_int" not in st.session_state:
@@ -19,6 +23,10 @@ def initialise_state():
         st.session_state.year_histogram_df = pd.DataFrame()
     if "search_info_retrieval" not in st.session_state:
         st.session_state.search_info_retrieval = []
+    if "local_analytics" not in st.session_state:
+        st.session_state.local_analytics = False
+    if "display_selection" not in st.session_state:
+        st.session_state.display_selection = []
     # if "barchartname" not in st.session_state:#might need this later
     #     st.session_state.barchartname = ""
     # if "piechartname" not in st.session_state:
@@ -69,6 +77,13 @@ def settings_menu():
         else:
             st.sidebar.error("❌ Please enter a valid integer.")
 
+    st.sidebar.toggle(
+        "Local analytics",
+        key="local_analytics",
+        help="Answer frequencies, crosstabs and drill-downs from a local incidence "
+        "matrix, built once from the record lists of all codes",
+    )
+
 
 # def aggrid_view(df):
 #     """
@@ -140,106 +155,96 @@ def settings_menu():
 #                         "\" target=\"_blank\">" + ag.selected_data["url"].values[0] + "</a>")
 
 
-def adding(lines, key, value):
-    if len(value) > 0:
-        lines.append("{}  - {}".format(key, value.strip()))
-    return lines
-
-
-def add_record(lines, i, row):
-    pt = str(row["typeName"]).replace(",", "").strip()
-
-    #
-    lines.append("TY  - JOUR")
-    lines = adding(lines, "T1", str(row["title"]))
-    # lines = adding(lines, "OP", str(row["OriginalTitle"]))
-    lines = adding(lines, "N2", str(row["abstract"]))
-    for a in row["authors"].split(";"):
-        lines = adding(lines, "A1", str(a).strip())
-    lines = adding(lines, "IS", str(row["issue"]))
-    lines = adding(lines, "VL", str(row["volume"]))
-
-    lines = adding(lines, "JO", str(row["parentTitle"]))
-    lines = adding(lines, "SP", str(row["pages"]))
-    try:
-        lines = adding(
-            lines, "PY", str(int(row["year"]))
-        )  # or else we will get a float, ie. year 2022.0
-    except:
-        lines = adding(lines, "PY", str(row["year"]))
-    # lines = adding(lines, "LA", str(row["Language"]))
-    # lines = adding(lines, "AD", str(row["User defined 3"]))
-    lines = adding(lines, "SN", str(row["standardNumber"]))
-    lines = adding(lines, "DO", str(row["doi"]))
-    lines = adding(lines, "CY", str(row["city"]))
-    lines = adding(lines, "PB", str(row["publisher"]))
-    lines = adding(lines, "UR", str(row["url"]))
-
-    # lines = adding(lines, "KW", str(row["Language"]))
-    # lines = adding(lines, "KW", pt)
-    # lines = adding(lines, "KW", str(row["Language"]))
-    # lines = adding(lines, "ET", str(row["Edition"]))
-
-    #####################add a notes field
-
-    notes = str(row["quickCitation"])
-    lines.append("N1  - {}".format(notes))
-    lines.append("ER  - ")
-    lines.append("")
-    return lines
-
-
-def to_ris(df):
-    lines = []
-    for i, row in df.iterrows():
-        lines = add_record(lines, i, row)
-
-    lines = "\n".join(lines)
-    return lines
-
-
-def downloader(indf):
+# bound for the number of exports convert_for_download keeps
+DOWNLOAD_CACHE_ENTRIES = 16
+
+
+# keyed on the fingerprint of df (its itemIds, columns and row hashes, in
+# order) instead of pickling all of its cells
+@st.cache_data(
+    ttl=RESPONSE_CACHE_TTL,
+    max_entries=DOWNLOAD_CACHE_ENTRIES,
+    hash_funcs={pd.DataFrame: frame_fingerprint},
+)
+def convert_for_download(df, export_format):
+    return export_bytes(df, export_format)
+
+
+def export_selection(selection, export_format):
+    """
+    Export all records of a selection, page by page and with a progress bar,
+    to a temporary file kept in st.session_state.full_export (replacing the
+    file of the previous export). The file is removed with the session state
+    (see exports.ExportFile).
+
+    args:
+        selection: list of (attId, setId) pairs whose records are OR'ed
+        export_format: key of exports.EXPORT_FORMATS
+    """
+    registry = st.session_state.attribute_registry
+    attributes = [
+        a for a in (registry.get(i, s) for i, s in selection) if a is not None
+    ]
+    progress = st.progress(0.0, text="Exporting records...")
+
+    def on_page(done, total):
+        progress.progress(
+            done / total if total > 0 else 1.0,
+            text="Exported {} of {} records".format(done, total),
+        )
+
+    export = export_file(selection_pages(attributes, on_page), export_format)
+    progress.empty()
+
+    previous = st.session_state.get("full_export")
+    if previous is not None:
+        previous[2].remove()
+    st.session_state.full_export = (tuple(selection), export_format, export)
+
+
+def downloader(indf, selection=None):
+    """
+    Download options for a df of records, and a link to the dashboard.
+
+    args:
+        indf: df of the records on display
+        selection: optional list of (attId, setId) pairs the records were
+            selected by (OR); all records of the selection can then be
+            exported, not only those in indf
+    """
     d1, d2 = st.columns(2)
     with d1:
-        if st.button("Download Options", icon=":material/download:"):
-            with st.popover("Select"):
-
-                @st.cache_data
-                def convert_ris_download(df):
-                    return to_ris(df)
-
-                @st.cache_data
-                def convert_for_download(df, encoding):
-                    return df.to_csv().encode(encoding)
-
-                # csv1 = convert_for_download(dfs[0], "utf-8")
-                myris = convert_ris_download(indf)
-                st.download_button(
-                    label="RIS",
-                    data=myris,
-                    file_name="data_{}_records.ris".format(indf.shape[0]),
-                    mime="text/csv",
-                    icon=":material/download:",
-                )
-
-                csv1 = convert_for_download(indf, "utf-8-sig")
-
-                st.download_button(
-                    label="Download CSV (UTF-8-sig)",
-                    data=csv1,
-                    file_name="data_{}_records.csv".format(indf.shape[0]),
-                    mime="text/csv",
-                    icon=":material/download:",
-                )
-                # csv2 = convert_for_download(dfs[0], "windows-1252")
-                #
-                # st.download_button(
-                #     label="Download Windows-1252 CSV",
-                #     data=csv2,
-                #     file_name="data_{}_records.csv".format(dfs[0].shape[0]),
-                #     mime="text/csv",
-                #     icon=":material/download:",
-                # )
+        with st.popover("Download Options", icon=":material/download:"):
+            export_format = st.radio(
+                "Format", list(EXPORT_FORMATS), horizontal=True
+            )
+            _, extension, mime = EXPORT_FORMATS[export_format]
+            st.download_button(
+                label="Download {} ({} records)".format(export_format, indf.shape[0]),
+                data=convert_for_download(indf, export_format),
+                file_name="data_{}_records.{}".format(indf.shape[0], extension),
+                mime=mime,
+                icon=":material/download:",
+            )
+
+            if selection:
+                st.divider()
+                if st.button("Export all records of the selection"):
+                    export_selection(selection, export_format)
+                full_export = st.session_state.get("full_export")
+                if (
+                    full_export is not None
+                    and full_export[:2] == (tuple(selection), export_format)
+                    and full_export[2].exists()
+                ):
+                    with open(full_export[2].path, "rb") as f:
+                        st.download_button(
+                            label="Download {} (all records)".format(export_format),
+                            data=f,
+                            file_name="data_all_records.{}".format(extension),
+                            mime=mime,
+                            icon=":material/download:",
+                        )
     with d2:
         st.session_state.dashboard_df = indf
         st.page_link(